@@ -4,7 +4,9 @@ import pyttman.core.containers
 from pyttman.core.entity_parsing.fields import StringEntityField, BoolEntityField
 from pyttman.core.intent import Intent
 
+from jarvis.abilities.finance.caches import household_roster
 from jarvis.models import Features
+from jarvis.utils import vocabularies
 
 
 class UserFeatureEnrollment(Intent):
@@ -51,8 +53,13 @@ class UserFeatureEnrollment(Intent):
             if feature.value not in message.user.enrolled_features:
                 message.user.enrolled_features.append(feature.value)
                 message.user.save()
+                household_roster.invalidate()
+                vocabularies.invalidate("enrolled_usernames")
             return pyttman.core.containers.Reply("Funktionen har aktiverats.")
         elif message.entities["deactivate_feature"]:
-            if feature.value not in message.user.enrolled_features:
+            if feature.value in message.user.enrolled_features:
                 message.user.enrolled_features.remove(feature.value)
+                message.user.save()
+                household_roster.invalidate()
+                vocabularies.invalidate("enrolled_usernames")
             return pyttman.core.containers.Reply("Funktionen har inaktiverats.")
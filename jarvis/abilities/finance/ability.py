@@ -1,16 +1,28 @@
+import re
+import threading
+import traceback
 from datetime import datetime
-from typing import Collection
 
+import numpy
 import pyttman
+import requests
+from bson import ObjectId
+from mongoengine import Q, QuerySet, ValidationError
 from pyttman.core.ability import Ability
 from pyttman.core.containers import Message, ReplyStream, Reply
 
+from jarvis.abilities.finance.analytics import ExpenseStatistics
+from jarvis.abilities.finance.caches import AccountingPeriodCache
 from jarvis.abilities.finance.calculator import SharedFinancesCalculator
+from jarvis.abilities.finance.exporter import ExpenseExporter
+from jarvis.abilities.finance.importer import ExpenseImporter
 from jarvis.abilities.finance import intents
-from jarvis.abilities.finance.models import Debt, AccountingEntry, Expense
+from jarvis.abilities.finance.models import Debt, AccountingEntry, \
+    AccountingSnapshot, ArchivedExpense, Expense, ExpenseLedger
 from jarvis.abilities.finance.month import Month
+from jarvis.abilities.finance.simulator import IncomeSplitSimulator
 from jarvis.models import User
-from jarvis.utils import extract_username
+from jarvis.utils import extract_username, get_username_from_message
 
 
 class FinanceAbility(Ability):
@@ -24,13 +36,26 @@ class FinanceAbility(Ability):
     """
     intents = (intents.AddExpense,
                intents.GetExpenses,
+               intents.GetNextExpensesPage,
+               intents.GetExpenseStatistics,
+               intents.ImportExpenses,
+               intents.ExportExpenses,
                intents.CalculateSplitExpenses,
+               intents.SimulateIncomeSplit,
                intents.AddDebt,
                intents.GetDebts,
                intents.RepayDebt,
+               intents.SettleDebts,
+               intents.GetLastAccountingEntry,
                intents.UndoLastClosingCalculatedExpense,
                intents.EnterMonthlyIncome,
-               intents.UndoLastExpense)
+               intents.UndoLastExpense,
+               intents.EndRecurringExpense)
+
+    debts_page_size = 10
+    expenses_page_size = 15
+    simulation_steps = 1001
+    new_participant_names = ("ny", "nya", "medlem", "person")
 
     def before_create(self) -> None:
         """
@@ -51,9 +76,19 @@ class FinanceAbility(Ability):
                                               "kontrollera att du är "
                                               "registrerad."})
 
+        # The start of the current accounting period is read on most
+        # finance messages, but only moves when a period is closed or
+        # the closing is undone. It's loaded lazily since the database
+        # connection isn't established until the app starts.
+        self.storage.put("accounting_period", AccountingPeriodCache())
+
+        # Listings of expenses which continue on a next page, by author
+        self.storage.put("expense_listings", {})
+
     def add_expense(self, message: Message):
         """
-        Add a shared expense.
+        Add a shared expense, or several in one message separated
+        by commas, such as 'spara utgifter mat 450, bensin 600'.
         """
         stream = ReplyStream()
         expense_name = message.entities.get("expense_name")
@@ -61,10 +96,15 @@ class FinanceAbility(Ability):
         store_for_username = extract_username(message, "store_for_username")
         recurring = message.entities.get("recurring")
         private = message.entities.get("private")
+        parsed_expenses, unparsed_segments = self._parse_expenses_in_message(message)
 
+        # Several expenses are saved all or nothing, so none are lost
+        if unparsed_segments and len(parsed_expenses) + len(unparsed_segments) > 1:
+            segments = ", ".join(f"'{segment}'" for segment in unparsed_segments)
+            return Reply(f"Jag förstod inte {segments}, så inga utgifter sparades. "
+                         "Ange varje utgift med namn och pris, som 'mat 450, bensin 600'.")
 
-
-        if not expense_value and expense_name:
+        if not expense_value and expense_name and len(parsed_expenses) < 2:
             return Reply("Du måste ange både namn och "
                          "pris på vad du har köpt.")
 
@@ -73,33 +113,158 @@ class FinanceAbility(Ability):
             pyttman.logger.log(f"No db User matched: {store_for_username}")
             return Reply(self.storage["default_replies"]["no_users_matches"])
 
-        expense = Expense.objects.create(price=expense_value,
-                                         expense_name=expense_name,
-                                         user_reference=user,
-                                         recurring_monthly=recurring,
-                                         shared=not private)
+        if len(parsed_expenses) < 2:
+            parsed_expenses = [(expense_name, expense_value)]
+        expenses = [Expense(price=price,
+                            expense_name=name,
+                            user_reference=user,
+                            recurring_monthly=recurring,
+                            shared=not private)
+                    for name, price in parsed_expenses]
+        # insert() doesn't validate the documents, unlike save()
+        try:
+            for expense in expenses:
+                expense.validate()
+        except ValidationError as e:
+            pyttman.logger.log(f"Invalid expense not saved: {e}")
+            return Reply("Utgiften kunde inte sparas. Kontrollera "
+                         "namnet och priset på vad du har köpt.")
+        expense_ids = Expense.objects.insert(expenses, load_bulk=False)
+
+        period_start = self._get_last_accounting_entry_datetime()
+        if recurring:
+            # Charged in this period by their first occurrence
+            Expense.objects(id__in=expense_ids).materialize_recurring(period_start)
+        else:
+            ExpenseLedger.objects.book(*expenses, period_start=period_start)
 
-        stream.put(f"Utgiften sparades för {user.username.capitalize()}.")
+        if len(expenses) > 1:
+            stream.put(f"{len(expenses)} utgifter sparades för "
+                       f"{user.username.capitalize()}, totalt "
+                       f"**{sum(expense.price for expense in expenses)}**:-.")
+        else:
+            stream.put(f"Utgiften sparades för {user.username.capitalize()}.")
         if recurring:
-            stream.put("Utgiften är markerad som återkommande.")
+            stream.put("Utgifterna är markerade som återkommande."
+                       if len(expenses) > 1 else "Utgiften är markerad som återkommande.")
         if private:
-            stream.put("Den har bokförts som en privat utgift bara för dig.")
+            stream.put("De har bokförts som privata utgifter bara för dig."
+                       if len(expenses) > 1 else "Den har bokförts som en privat utgift bara för dig.")
 
-        stream.put(expense)
-        calculator = SharedFinancesCalculator()
-        enrolled_users = calculator.get_enrolled_users()
+        for expense in expenses:
+            stream.put(expense)
+        budget_amount_left = self._get_budget_amount_left(period_start)
+        stream.put(f"Ni har {budget_amount_left}:- kvar av er inkomst för denna period.")
+        return stream
 
-        household_income = sum(user.profile.gross_income
-                               for user in enrolled_users)
-        expense_sum = calculator.calculate_split(
-            participant_users=calculator.get_enrolled_users(),
-            range_start=self._get_last_accounting_entry_datetime()
-        ).pop().paid_amount
+    @staticmethod
+    def _parse_expenses_in_message(message: Message) -> tuple[list[tuple[str, int]], list[str]]:
+        """
+        Parse comma separated expenses, such as 'mat 450, bensin 600',
+        in to (name, price) pairs. Command words and flags before and
+        after each expense are left out. Returns the expenses, and the
+        segments which couldn't be parsed as an expense.
+        """
+        command_words = {*intents.AddExpense.lead, *intents.AddExpense.trail,
+                         *intents.AddExpense.flag_words, "för", "till"}
+        if username := message.entities.get("store_for_username"):
+            command_words.add(str(username).casefold())
+
+        expenses, unparsed_segments = [], []
+        for segment in message.as_str().split(","):
+            words = segment.split()
+            while words and words[0].casefold() in command_words:
+                words.pop(0)
+            while words and words[-1].casefold() in command_words:
+                words.pop()
+            if not words:
+                continue
+            if match := re.fullmatch(r"(.+?)\s+(\d+)\s*(?::-|kr)?", " ".join(words), re.IGNORECASE):
+                expenses.append((match[1], int(match[2])))
+            else:
+                unparsed_segments.append(segment.strip())
+        return expenses, unparsed_segments
 
-        budget_amount_left = max(0, int(household_income - expense_sum))
-        stream.put(f"Ni har {budget_amount_left}:- kvar av er inkomst för denna period.")
+    def import_expenses(self, message: Message) -> Reply | ReplyStream:
+        """
+        Import expenses in bulk for the author, from a CSV file
+        attached to the message.
+        """
+        if not (attachments := getattr(message, "attachments", None)):
+            return Reply("Bifoga en CSV-fil med utgifterna du vill importera, "
+                         "till exempel en export av transaktioner från banken.")
+        if message.user is None:
+            return Reply(self.storage["default_replies"]["no_users_matches"])
+
+        importer = ExpenseImporter(user=message.user,
+                                   shared=not message.entities.get("private"))
+        try:
+            with requests.get(attachments[0].url, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                result = importer.import_lines(response.iter_lines())
+        except requests.RequestException as e:
+            pyttman.logger.log(f"Failed to download attachment: {e}")
+            return Reply("Jag kunde inte läsa den bifogade filen, försök igen.")
+
+        stream = ReplyStream()
+        stream.put(f"Importerade **{result.imported}** utgifter för "
+                   f"{message.user.username.capitalize()}.")
+        if result.skipped:
+            stream.put(f"{result.skipped} rader var insättningar och hoppades över.")
+        if result.errors:
+            stream.put(f"{len(result.errors)} rader kunde inte läsas:\n"
+                       + "\n".join(result.errors[:10]))
+        if result.imported:
+            budget_amount_left = self._get_budget_amount_left(
+                self._get_last_accounting_entry_datetime())
+            stream.put(f"Ni har {budget_amount_left}:- kvar av er inkomst för denna period.")
         return stream
 
+    def export_expenses(self, message: Message) -> Reply:
+        """
+        Export the expenses in a period to an xlsx or CSV file,
+        attached to the reply. The period defaults to the current
+        accounting period.
+        """
+        range_start, range_end = None, None
+        try:
+            if (period_start := message.entities.get("period_start")) is not None:
+                range_start = datetime.strptime(period_start, pyttman.app.settings.DATE_FORMAT)
+            elif not message.entities.get("all_expenses"):
+                range_start = self._get_last_accounting_entry_datetime()
+            if (period_end := message.entities.get("period_end")) is not None:
+                range_end = datetime.strptime(period_end, pyttman.app.settings.DATE_FORMAT)
+        except ValueError:
+            return Reply("Jag förstår inte vilken period du vill exportera. "
+                         "Ange datum som ÅÅÅÅ-MM-DD.")
+
+        exporter = ExpenseExporter(range_start=range_start, range_end=range_end)
+        if message.entities.get("as_csv"):
+            expenses_file, file_extension = exporter.to_csv(), "csv"
+        else:
+            expenses_file, file_extension = exporter.to_xlsx(), "xlsx"
+        if expenses_file is None:
+            return Reply(self.storage["default_replies"]["no_expenses_matched"])
+
+        period = "_".join(dt.strftime("%Y-%m-%d") for dt in (range_start, range_end)
+                          if dt is not None) or "alla"
+        return Reply("Här är utgifterna! :smiley:",
+                     file=expenses_file,
+                     file_name=f"utgifter_{period}.{file_extension}")
+
+    @staticmethod
+    def _get_budget_amount_left(period_start: datetime | None) -> int:
+        """
+        The household income, less the expenses of the enrolled
+        users in the period.
+        """
+        enrolled_users = SharedFinancesCalculator.get_enrolled_users()
+        household_income = sum(user.profile.gross_income
+                               for user in enrolled_users)
+        expense_sum = sum(row.total for row in ExpenseLedger.objects.for_period(
+            period_start).filter(user_reference__in=enrolled_users))
+        return max(0, int(household_income - expense_sum))
+
     def get_expenses(self, message: Message):
         """
         Return expenses for a user, all in one reply stream
@@ -128,22 +293,20 @@ class FinanceAbility(Ability):
         if get_latest:
             return Reply(Expense.objects.latest(user=user))
         if recurring_expenses_only:
-            return ReplyStream(Expense.objects.recurring(user=user))
-
-        expenses = Expense.objects.within_period(
-            range_start=last_accounting_entry_date,
-            user=user,
-            shared_only=shared_only,
-            private_only=private_only)
-
-        recurring_expenses = Expense.objects.recurring(user=user)
-
-        if not expenses and not recurring_expenses:
-            return Reply(self.storage["default_replies"]["no_expenses_matched"])
+            return ReplyStream(Expense.objects.recurring(user=user,
+                                                         active_at=datetime.utcnow()))
 
         if message.entities.get("sum_expenses"):
-            expenses_sum = expenses.sum("price")
-            recurring_sum = recurring_expenses.sum("price")
+            if (ledger := ExpenseLedger.objects.for_period(
+                    last_accounting_entry_date).filter(user_reference=user).first()) is None:
+                return Reply(self.storage["default_replies"]["no_expenses_matched"])
+            if shared_only:
+                expenses_sum = ledger.shared
+            elif private_only:
+                expenses_sum = ledger.private
+            else:
+                expenses_sum = ledger.shared + ledger.private
+            recurring_sum = ledger.recurring
             period_str = (f"{last_accounting_entry_date.strftime('%Y-%m-%d')} - "
                           f"{datetime.now().strftime('%Y-%m-%d')}")
             stream.put(f"Nuvarande konteringsperiod: {period_str}")
@@ -153,13 +316,106 @@ class FinanceAbility(Ability):
                          f"Varav återkommande utgifter: **{recurring_sum}**:-\n"
                          f"Varav engångsutgifter: **{expenses_sum}**:-")
 
-        expenses = list(expenses.all())
-        if message.entities.get("limit"):
-            expenses = expenses[len(expenses) - message.entities["limit"]:]
+        expenses = Expense.objects.within_period(
+            range_start=last_accounting_entry_date,
+            user=user,
+            shared_only=shared_only,
+            private_only=private_only)
+
+        page_size = message.entities.get("limit") or self.expenses_page_size
+        page = self._get_expenses_page(get_username_from_message(message),
+                                       expenses=expenses,
+                                       page_size=page_size)
+        if not page:
+            return Reply(self.storage["default_replies"]["no_expenses_matched"])
+
+        for expense in page:
+            stream.put(expense)
+        if self._has_next_expenses_page(message):
+            stream.put("Skriv 'nästa sida' för att visa äldre utgifter.")
+        return stream
+
+    def get_next_expenses_page(self, message: Message) -> Reply | ReplyStream:
+        """
+        Continue the most recent listing of expenses for the author,
+        from where the last page ended.
+        """
+        if not self._has_next_expenses_page(message):
+            return Reply("Det finns inga fler utgifter att visa. "
+                         "Skriv 'visa utgifter' för att börja om.")
+
+        listing_key = get_username_from_message(message)
+        stream = ReplyStream()
+        for expense in self._get_expenses_page(listing_key,
+                                               **self.storage["expense_listings"][listing_key]):
+            stream.put(expense)
+        if self._has_next_expenses_page(message):
+            stream.put("Skriv 'nästa sida' för att visa äldre utgifter.")
+        return stream
+
+    def _get_expenses_page(self,
+                           listing_key: str,
+                           expenses: QuerySet,
+                           page_size: int,
+                           cursor: tuple[datetime, ObjectId] = None) -> list[Expense]:
+        """
+        Get a page of expenses, newest first, with sort, cursor and
+        limit applied in the query. The page is returned oldest first
+        for readability. If there are more expenses, the listing is
+        stored with a cursor on the last expense, for the next page.
+        """
+        page_query = expenses
+        if cursor is not None:
+            created, expense_id = cursor
+            page_query = expenses.filter(Q(created__lt=created)
+                                         | Q(created=created, id__lt=expense_id))
+        page = list(page_query.order_by("-created", "-id").limit(page_size + 1))
+
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.storage["expense_listings"][listing_key] = {
+                "expenses": expenses,
+                "page_size": page_size,
+                "cursor": (page[-1].created, page[-1].id)}
         else:
-            if not private_only:
-                expenses.extend(recurring_expenses.all())
-        return ReplyStream(expenses)
+            self.storage["expense_listings"].pop(listing_key, None)
+        return page[::-1]
+
+    def _has_next_expenses_page(self, message: Message) -> bool:
+        return get_username_from_message(message) in self.storage["expense_listings"]
+
+    @staticmethod
+    def get_expense_statistics(message: Message) -> Reply | ReplyStream:
+        """
+        Reply with statistics over the shared expenses, optionally
+        limited to the last number of months.
+        """
+        months = message.entities.get("months")
+        if (statistics := ExpenseStatistics.from_database(months)).empty:
+            return Reply("Det finns inga delade utgifter att visa statistik för.")
+
+        stream = ReplyStream()
+        monthly_totals = statistics.monthly_totals()
+        rolling_average = statistics.rolling_average()
+        msg = "**:bar_chart: Delade utgifter per månad:**\n"
+        for month, total in monthly_totals.items():
+            month_name = Month(month.month).name.capitalize()
+            msg += (f"**{month_name} {month.year}:** {total}:- "
+                    f"(snitt 3 mån: {rolling_average[month]:.0f}:-)\n")
+        stream.put(msg)
+
+        user_shares = statistics.user_shares()
+        usernames = dict(User.objects(id__in=list(user_shares.index)).scalar("id", "username"))
+        msg = "**:couple: Andel av totalen:**\n"
+        for user_id, share in user_shares.items():
+            msg += f"**{usernames.get(user_id, '?').capitalize()}:** {share * 100:.1f}%\n"
+        stream.put(msg)
+
+        msg = "**:shopping_cart: Största kategorierna:**\n"
+        for expense_name, total in statistics.top_categories().items():
+            msg += f"**{expense_name.capitalize()}:** {total}:-\n"
+        stream.put(msg)
+        return stream
 
     @classmethod
     def register_debt(cls, message: Message) -> str:
@@ -221,18 +477,23 @@ class FinanceAbility(Ability):
         Get debts for users
         """
         reply_stream = ReplyStream()
-        debts_by_lender: dict[User, int] = {}
         if message.entities["author_is_borrower"]:
             borrower = message.user
         else:
             borrower_name = extract_username(message, "borrower_name")
             borrower: User = User.objects.from_username_or_alias(borrower_name)
-        debt_sum = Debt.objects.filter(borrower=borrower).sum("amount")
 
         if borrower is None:
             reply_stream.put("Hm, jag hittade inte personen som frågan gällde?")
             return reply_stream
 
+        debts = Debt.objects.filter(borrower=borrower)
+        sums_by_lender = {row["_id"]: row for row in debts.aggregate([
+            {"$group": {"_id": "$lender",
+                        "amount": {"$sum": "$amount"},
+                        "count": {"$sum": 1}}}])}
+        debt_sum = sum(row["amount"] for row in sums_by_lender.values())
+
         if debt_sum == 0:
             reply_stream.put(f"{borrower.username.capitalize()} "
                              f"har inga skulder! :sunglasses:")
@@ -242,18 +503,28 @@ class FinanceAbility(Ability):
                 f"**{borrower.username.capitalize()} har totalt {debt_sum}:- "
                 f"i skulder registrerade, se nedan:**")
 
-        for debt in Debt.objects.filter(borrower=borrower):
-            try:
-                debts_by_lender[debt.lender] += debt.amount
-            except KeyError:
-                debts_by_lender[debt.lender] = debt.amount
+        lenders = User.objects.only("username").in_bulk(list(sums_by_lender))
 
         if message.entities["individual"]:
-            for debt in Debt.objects.filter(borrower=borrower):
+            page = max(1, message.entities["page"] or 1)
+            debt_count = sum(row["count"] for row in sums_by_lender.values())
+            page_count = -(-debt_count // cls.debts_page_size)
+            debts_on_page = debts.order_by("-created").skip(
+                (page - 1) * cls.debts_page_size
+            ).limit(cls.debts_page_size).no_dereference()
+
+            for debt in debts_on_page:
+                debt.lender = lenders[debt.lender.id]
                 reply_stream.put(debt)
+            if page < page_count:
+                reply_stream.put(f"Sida {page} av {page_count}. Skriv 'visa "
+                                 f"individuella skulder sida {page + 1}' "
+                                 f"för att se fler.")
         else:
-            for lender, _sum in debts_by_lender.items():
-                debt = Debt(lender=lender, borrower=borrower, amount=_sum)
+            for lender_id, row in sums_by_lender.items():
+                debt = Debt(lender=lenders[lender_id],
+                            borrower=borrower,
+                            amount=row["amount"])
                 reply_stream.put(debt)
 
         return reply_stream
@@ -262,8 +533,7 @@ class FinanceAbility(Ability):
         """
         One user pays back another user, an amount of money.
         """
-        remaining_repaid_amount = repaid_amount = message.entities.get(
-            "repaid_amount")
+        repaid_amount = message.entities.get("repaid_amount")
         author_is_borrower = message.entities.get("author_is_borrower")
         mentioned_user = message.entities.get("mentioned_user")
 
@@ -284,44 +554,53 @@ class FinanceAbility(Ability):
         borrower_capitalized = borrower.username.capitalize()
         lender_capitalized = lender.username.capitalize()
 
-        # Get debts common to this borrower and lender
-        # Order the debts by amount, desc
-        debts: Collection[Debt] = Debt.objects.filter(
+        overpaid_amount, total_debt_balance = Debt.objects.repay(
             borrower=borrower,
-            lender=lender
-        ).order_by(
-            "amount")
-
-        for debt in debts:
-            if remaining_repaid_amount <= 0:
-                break
-            debt_amount_before_reduce = debt.amount
-            debt.amount -= remaining_repaid_amount
-            remaining_repaid_amount -= debt_amount_before_reduce
-            debt.delete() if debt.amount <= 0 else debt.save()
+            lender=lender,
+            amount=repaid_amount)
 
         # Looks like the user overpaid.
-        # Create a new compensation_amount going the other way.
-        if remaining_repaid_amount > 0:
-            Debt.objects.create(amount=remaining_repaid_amount,
-                                lender=borrower,
-                                borrower=lender)
+        # A new debt going the other way was created.
+        if overpaid_amount > 0:
             reply = Reply(
                 f"{borrower_capitalized} har överbetalat "
-                f"dig med **{remaining_repaid_amount}:-**. En skuld "
+                f"dig med **{overpaid_amount}:-**. En skuld "
                 f"har skapats {borrower_capitalized} har lånat ut *"
-                f"*{remaining_repaid_amount}**:- till "
+                f"*{overpaid_amount}**:- till "
                 f"{lender_capitalized}.")
         else:
-            total_debt_balance = Debt.objects.filter(
-                borrower=borrower, lender=lender
-            ).sum("amount")
             reply = Reply(f"{borrower_capitalized} har "
                           f"minskat sin skuld till {lender_capitalized} "
                           f"med **{repaid_amount}**:-, och är nu skyldig "
                           f"{total_debt_balance}:-")
         return reply
 
+    def settle_debts(self, message: Message) -> Reply | ReplyStream:
+        """
+        Reply with the smallest set of transfers which settles all
+        debts, and optionally the split of the current period.
+        """
+        calculator = SharedFinancesCalculator()
+        try:
+            transfers = calculator.plan_settlement(
+                include_split=message.entities["include_expenses"],
+                range_start=self._get_last_accounting_entry_datetime())
+        except ValueError:
+            return Reply("Åtminstone en användare har inte angivit månadsinkomst.")
+
+        if not transfers:
+            return Reply("Det finns inget att avräkna, alla är kvitt! :sunglasses:")
+
+        reply_stream = ReplyStream()
+        reply_stream.put(f"**Avräkning:** {len(transfers)} överföring(ar) "
+                         f"gör alla kvitt.")
+        for transfer in transfers:
+            reply_stream.put(f":money_with_wings: "
+                             f"{transfer.debtor.username.capitalize()} betalar "
+                             f"**{transfer.amount:.2f}**:- till "
+                             f"{transfer.creditor.username.capitalize()}.")
+        return reply_stream
+
     def calculate_split_expenses(self, message):
         """
         Perform an accounting entry, splitting expenses and create a balance
@@ -364,76 +643,251 @@ class FinanceAbility(Ability):
             return Reply("Åtminstone en användare har inte angivit månadsinkomst.")
 
         reply_stream = ReplyStream()
-        accounting_entry = AccountingEntry()
+        accounting_entry = AccountingEntry(period_start=period_start,
+                                           period_end=period_end,
+                                           total_expense_sum=calculator.total_expense_sum)
         dt_fmt = pyttman.app.settings.DATETIME_FORMAT
         reply_stream.put(f"**Konteringsunderlag**: {datetime.now().strftime(dt_fmt)}")
         period = f"**{period_start.strftime('%Y-%m-%d')} - " \
                  f"{period_end.strftime('%Y-%m-%d')}**"
         reply_stream.put(f"Konteringsperiod: {period}")
-        msg = f"**Konteringsperiod: {period}**\n"
-        valid = False
 
-        while calculations:
-            calculation = calculations.pop()
-            username = calculation.user.username.capitalize()
+        for calculation in reversed(calculations):
+            snapshot = AccountingSnapshot.from_calculation(calculation)
             accounting_entry.participants.append(calculation.user)
+            accounting_entry.snapshots.append(snapshot)
+            reply_stream.put(snapshot.as_str(calculator.total_expense_sum))
 
-            msg = f"\n:moneybag: **{username}:**\n"
-            msg += f"**Summa:** {calculation.paid_amount:.2f}:- \n" \
-                   f"**Belastning:** {calculation.quota_of_total * 100:.2f}% av " \
-                   f"totalen {calculator.total_expense_sum:.2f}:-.\n"
-            if calculation.recurring_expenses:
-                msg += f"**Varav återkommande utgifter:** {calculation.recurring_expenses:.2f}:- \n"
-
-            msg += f"**Månadslön:** {calculation.income_quotient * 100:.2f}% av den " \
-                   f"totala inkomsten av deltagarna.\n"
-
-            if calculation.ingoing_compensation:
-                msg += f"**Ska kompenseras med:** {calculation.ingoing_compensation:.2f}:- från övriga " \
-                       f"deltagare."
-            elif calculation.outgoing_compensation:
-                msg += f"**Ska kompensera andra med** {calculation.outgoing_compensation:.2f}:-"
-            else:
-                msg += f"**{username} har betalat exakt sin kvot och ska varken " \
-                       f"kompenseras eller kompensera andra."
-
-            valid = True
-            reply_stream.put(msg)
-
-        accounting_entry.accounting_result = msg
-        if not valid:
+        if not accounting_entry.snapshots:
             return Reply("Det finns inga utgifter att kontera för, sedan förra konteringen: "
                          f"{period_start.strftime('%Y-%m-%d %H:%M')}")
+        accounting_entry.accounting_result = "\n".join(
+            snapshot.as_str(calculator.total_expense_sum)
+            for snapshot in accounting_entry.snapshots)
         if message.entities["close_current_period"]:
             accounting_entry.save()
+            self.storage["accounting_period"].set(accounting_entry.created)
+            # Charged before replying, so that the new period's split,
+            # budget and ledger include the recurring expenses at once
+            Expense.objects.materialize_recurring(accounting_entry.created)
+            threading.Thread(target=self._archive_closed_periods, daemon=True).start()
             reply_stream.put("Kontering sparad. Utgifter som läggs till från och med nu "
                              "kommer ingå i ett nytt resultat.")
         return reply_stream
 
     @staticmethod
-    def _get_last_accounting_entry_datetime() -> datetime | None:
+    def get_last_accounting_entry(message: Message) -> Reply | ReplyStream:
         """
-        Get the date of the last accounting entry. If there's no entry, return None.
+        Reply with the most recently closed accounting period, read
+        from its snapshots. Optionally compared with the period
+        before it.
         """
-        if last_account_entry := AccountingEntry.objects.order_by('-created').first():
-            return last_account_entry.created
-        return None
+        entries = list(AccountingEntry.objects.order_by("-created").limit(2))
+        if not entries:
+            return Reply("Det finns ingen kontering att visa.")
+        last_entry, *previous_entry = entries
 
-    @classmethod
-    def delete_last_created_account_entry(cls) -> None:
+        reply_stream = ReplyStream()
+        dt_fmt = pyttman.app.settings.DATETIME_FORMAT
+        reply_stream.put(f"**Kontering stängd**: {last_entry.created.strftime(dt_fmt)}")
+        if not last_entry.snapshots:
+            # Closed before snapshots were stored
+            reply_stream.put(last_entry.accounting_result)
+            return reply_stream
+
+        period_start = last_entry.period_start.strftime('%Y-%m-%d') \
+            if last_entry.period_start else "början"
+        reply_stream.put(f"Konteringsperiod: **{period_start} - "
+                         f"{last_entry.period_end.strftime('%Y-%m-%d')}**")
+        for snapshot in last_entry.snapshots:
+            reply_stream.put(snapshot.as_str(last_entry.total_expense_sum))
+
+        if not message.entities["compare"]:
+            return reply_stream
+        if not previous_entry or not previous_entry[0].snapshots:
+            reply_stream.put("Det finns ingen tidigare kontering att jämföra med.")
+            return reply_stream
+
+        previous_entry = previous_entry[0]
+        previous_paid = {snapshot.username: snapshot.paid_amount
+                         for snapshot in previous_entry.snapshots}
+        change = last_entry.total_expense_sum - previous_entry.total_expense_sum
+        msg = f"**:chart_with_upwards_trend: Jämfört med förra perioden:**\n" \
+              f"**Totalt:** {last_entry.total_expense_sum:.2f}:- ({change:+.2f}:-)\n"
+        for snapshot in last_entry.snapshots:
+            msg += f"**{snapshot.username.capitalize()}:** {snapshot.paid_amount:.2f}:- "
+            if (paid := previous_paid.get(snapshot.username)) is not None:
+                msg += f"({snapshot.paid_amount - paid:+.2f}:-)\n"
+            else:
+                msg += "(deltog inte förra perioden)\n"
+        reply_stream.put(msg)
+        return reply_stream
+
+    def simulate_income_split(self, message: Message) -> Reply | ReplyStream:
         """
-        Deletes the most-recent accounting entry object.
+        Simulate the split of the current period with other incomes,
+        given as 'name income' or 'name lowest-highest' for a range
+        of incomes. A new participant is added with 'ny income'.
         """
-        if last_entry := AccountingEntry.objects.order_by("-created").first():
-            last_entry.delete()
-            return last_entry
-        return None
+        scenario = re.findall(r"([^\W\d]+)\s+(\d+)(?:\s*-\s*(\d+))?", message.as_str())
+        if not scenario:
+            return Reply("Ange vilka inkomster du vill simulera, till exempel "
+                         "'simulera Simon 40000' eller 'simulera Simon 30000-50000'.")
+
+        participant_users = SharedFinancesCalculator.get_enrolled_users()
+        try:
+            simulator = IncomeSplitSimulator.for_period(
+                participant_users, range_start=self._get_last_accounting_entry_datetime())
+        except ValueError:
+            return Reply("Åtminstone en användare har inte angivit månadsinkomst.")
+        current_compensations = simulator.compensations()[0]
+
+        incomes = simulator.incomes.copy()
+        swept_participant, swept_incomes = None, None
+        for name, income, highest_income in scenario:
+            if name.casefold() in self.new_participant_names:
+                simulator = simulator.with_participant("Ny medlem", float(income))
+                incomes = numpy.append(incomes, float(income))
+                current_compensations = numpy.append(current_compensations, 0)
+                participant = len(incomes) - 1
+            elif name.casefold() in (usernames := [p.casefold() for p in simulator.participants]):
+                participant = usernames.index(name.casefold())
+                incomes[participant] = float(income)
+            else:
+                continue
+            if highest_income:
+                swept_participant = participant
+                swept_incomes = numpy.linspace(*sorted((float(income), float(highest_income))),
+                                               self.simulation_steps)
+
+        stream = ReplyStream()
+        if swept_participant is None:
+            compensations = simulator.compensations(incomes)[0]
+            msg = "**:crystal_ball: Simulerad fördelning för perioden:**\n"
+            for name, income, current, simulated in zip(simulator.participants, incomes,
+                                                        current_compensations, compensations):
+                msg += f"**{name.capitalize()}** ({income:.0f}:-): " \
+                       f"{self._describe_compensation(simulated)} " \
+                       f"(nu: {self._describe_compensation(current)})\n"
+            stream.put(msg)
+            return stream
+
+        simulator.incomes = incomes
+        name = simulator.participants[swept_participant].capitalize()
+        compensations = simulator.compensations(simulator.scenarios(swept_participant,
+                                                                    swept_incomes))
+        msg = f"**:crystal_ball: Simulerade {len(swept_incomes)} inkomster för {name}, " \
+              f"{swept_incomes[0]:.0f}:- till {swept_incomes[-1]:.0f}:-:**\n"
+        for participant, participant_name in enumerate(simulator.participants):
+            msg += f"**{participant_name.capitalize()}:** " \
+                   f"{self._describe_compensation(compensations[0, participant])} till " \
+                   f"{self._describe_compensation(compensations[-1, participant])}\n"
+        if (break_even := simulator.break_even_income(swept_participant,
+                                                      swept_incomes)) is not None:
+            msg += f"Vid en inkomst på {break_even:.0f}:- är {name} kvitt."
+        stream.put(msg)
+        return stream
+
+    @staticmethod
+    def _describe_compensation(compensation: float) -> str:
+        if compensation > 0:
+            return f"betalar {compensation:.2f}:-"
+        return f"får {-compensation:.2f}:-"
 
     @staticmethod
-    def delete_last_expense(message):
+    def _archive_closed_periods() -> None:
+        """
+        Archive expenses in periods which are no longer edited. Run
+        in the background when a period is closed; it's retried the
+        next time a period is closed, if it fails.
+        """
+        try:
+            Expense.objects.archive_closed_periods()
+        except Exception:
+            pyttman.logger.log("Archiving expenses in closed periods failed: "
+                               f"{traceback.format_exc()}", "error")
+
+    def _get_last_accounting_entry_datetime(self) -> datetime | None:
+        """
+        Get the date of the last accounting entry. If there's no entry, return None.
+        """
+        return self.storage["accounting_period"].get()
+
+    def delete_last_created_account_entry(self) -> AccountingEntry | None:
+        """
+        Deletes the most-recent accounting entry object.
+        The entry before it, if any, becomes the start of the
+        current accounting period.
+        """
+        if not (entries := list(AccountingEntry.objects.order_by("-created").limit(2))):
+            return None
+        last_entry, *previous_entry = entries
+        previous_period_start = previous_entry[0].created if previous_entry else None
+        last_entry.delete()
+        self.storage["accounting_period"].set(previous_period_start)
+
+        # The recurring expenses charged when the period opened are
+        # already charged in the period it's merged in to
+        occurrences = Expense.objects(recurrence_of__ne=None, created=last_entry.created)
+        ExpenseLedger.objects.book(*occurrences, period_start=last_entry.created, revert=True)
+        occurrences.delete()
+        ExpenseLedger.objects.merge_period(last_entry.created, previous_period_start)
+
+        # The period may already be archived, if more than one closing
+        # has been undone
+        archived_expenses = ArchivedExpense.objects
+        if previous_period_start is not None:
+            archived_expenses = archived_expenses.filter(created__gte=previous_period_start)
+        archived_expenses.restore()
+        return last_entry
+
+    def delete_last_expense(self, message):
         """
         Delete the last expense entry.
         """
-        last_expense = Expense.objects.latest(user=message.user)
+        if (last_expense := Expense.objects.latest(user=message.user)) is None:
+            return None
+
+        # A recurring expense is charged in the current period by its
+        # occurrence, while one-off expenses belong to the period they
+        # were created in.
+        period_start = self._get_last_accounting_entry_datetime()
+        if last_expense.recurring_monthly:
+            expenses = list(Expense.objects(recurrence_of=last_expense,
+                                            created__gte=period_start or datetime.min))
+        else:
+            expenses = [last_expense]
+            if period_start is not None and last_expense.created < period_start:
+                period_start = AccountingEntry.objects(
+                    created__lte=last_expense.created
+                ).order_by("-created").scalar("created").first()
+
         last_expense.delete()
+        Expense.objects(id__in=[expense.id for expense in expenses]).delete()
+        ExpenseLedger.objects.book(*expenses, period_start=period_start, revert=True)
         return last_expense
+
+    def end_recurring_expense(self, message: Message) -> Reply:
+        """
+        End a recurring expense for the author. It remains charged
+        in the current period, but not in the periods after it.
+        """
+        expense_name = message.entities.get("expense_name")
+        now = datetime.utcnow()
+        recurring_expenses = Expense.objects.recurring(user=message.user, active_at=now)
+        if expense_name:
+            recurring_expenses = recurring_expenses.filter(
+                expense_name__icontains=expense_name)
+
+        if not (matches := list(recurring_expenses)):
+            return Reply("Jag hittade ingen pågående återkommande utgift "
+                         "som matchade.")
+        if len(matches) > 1:
+            names = ", ".join(expense.expense_name for expense in matches)
+            return Reply(f"Vilken av de återkommande utgifterna menar du? {names}")
+
+        expense, = matches
+        expense.recurring_end = now
+        expense.save()
+        return Reply(f"Den återkommande utgiften {expense.expense_name} är avslutad, "
+                     f"och belastar inte kommande perioder.")
@@ -0,0 +1,69 @@
+import pandas
+
+from jarvis.abilities.finance.models import Expense
+
+
+class ExpenseStatistics:
+    """
+    Analytics over the household's shared expenses.
+
+    The expenses, including archived ones, are loaded with a single
+    projection query in to a columnar DataFrame, holding only the
+    columns needed. All statistics are computed vectorized on that
+    frame.
+    """
+    columns = ["created", "price", "expense_name", "user_reference"]
+
+    def __init__(self, frame: pandas.DataFrame):
+        self.frame = frame
+        self.frame["month"] = pandas.to_datetime(frame["created"]).dt.to_period("M")
+
+    @classmethod
+    def from_database(cls, months: int | None = None) -> "ExpenseStatistics":
+        """
+        Load the shared one-off expenses, optionally only for the
+        last number of calendar months.
+        """
+        expenses = Expense.objects.filter(recurring_monthly=False, shared=True)
+        if months:
+            current_month = pandas.Timestamp.now("UTC").tz_localize(None).to_period("M")
+            first_month = (current_month - (months - 1)).to_timestamp()
+            expenses = expenses.filter(created__gte=first_month.to_pydatetime())
+        rows = expenses.aggregate_with_archive(
+            [{"$project": {column: 1 for column in cls.columns}}])
+        return cls(pandas.DataFrame.from_records(rows, columns=cls.columns))
+
+    @property
+    def empty(self) -> bool:
+        return self.frame.empty
+
+    def monthly_totals(self) -> pandas.Series:
+        """
+        Sum of the expenses for each month, including months
+        without any expenses.
+        """
+        totals = self.frame.groupby("month")["price"].sum()
+        all_months = pandas.period_range(totals.index.min(),
+                                         totals.index.max(),
+                                         freq="M")
+        return totals.reindex(all_months, fill_value=0)
+
+    def rolling_average(self, window: int = 3) -> pandas.Series:
+        """
+        Rolling average of the monthly totals over 'window' months.
+        """
+        return self.monthly_totals().rolling(window, min_periods=1).mean()
+
+    def user_shares(self) -> pandas.Series:
+        """
+        Each user's share of the total, keyed by user id.
+        """
+        totals = self.frame.groupby("user_reference")["price"].sum()
+        return (totals / totals.sum()).sort_values(ascending=False)
+
+    def top_categories(self, n: int = 5) -> pandas.Series:
+        """
+        The n largest categories by sum, expense names normalized.
+        """
+        names = self.frame["expense_name"].str.strip().str.casefold()
+        return self.frame["price"].groupby(names).sum().nlargest(n)
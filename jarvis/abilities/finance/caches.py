@@ -0,0 +1,105 @@
+import threading
+import time
+from datetime import datetime
+
+from jarvis.abilities.finance.models import AccountingEntry
+from jarvis.models import User, UserProfile, Features
+
+
+class ExpiringCache:
+    """
+    Base class for values read on most finance messages but
+    rarely written. The write paths update the cache through
+    'set' or drop it through 'invalidate'. Since other workers
+    may write as well, a cached value is considered stale after
+    'ttl_seconds' and is then reloaded from the database.
+
+    Subclasses implement '_load'.
+    """
+
+    def __init__(self, ttl_seconds: int = 60):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded_at: float | None = None
+
+    def get(self):
+        """
+        Get the cached value, reloading it if it's not loaded
+        yet or if it has expired.
+        """
+        with self._lock:
+            if self._loaded_at is not None and \
+                    time.monotonic() - self._loaded_at < self.ttl_seconds:
+                return self._value
+        return self.load()
+
+    def set(self, value) -> None:
+        """
+        Write-through for the write paths which change the value.
+        """
+        with self._lock:
+            self._value = value
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self) -> None:
+        """
+        Drop the cached value, having it reloaded on next access.
+        """
+        with self._lock:
+            self._value = None
+            self._loaded_at = None
+
+    def load(self):
+        """
+        Load the value from the database and cache it.
+        """
+        value = self._load()
+        self.set(value)
+        return value
+
+    def _load(self):
+        raise NotImplementedError
+
+
+class AccountingPeriodCache(ExpiringCache):
+    """
+    Caches the start of the current accounting period, which is
+    the 'created' timestamp of the most recent AccountingEntry.
+
+    The boundary only moves when a period is closed or when the
+    last closing is undone.
+    """
+
+    def _load(self) -> datetime | None:
+        return AccountingEntry.objects.order_by("-created").scalar("created").first()
+
+
+class HouseholdRosterCache(ExpiringCache):
+    """
+    Caches the users enrolled in the shared finances, with their
+    UserProfile loaded eagerly with a $lookup - so reading their
+    gross income doesn't dereference the profile for each user.
+
+    Invalidated when users enroll in features or enter their income.
+    """
+
+    def _load(self) -> list[User]:
+        users = []
+        enrolled_users = User.objects(
+            enrolled_features__contains=Features.shared_finances.value)
+        pipeline = [{"$lookup": {"from": UserProfile._get_collection_name(),
+                                 "localField": "_profile",
+                                 "foreignField": "_id",
+                                 "as": "profiles"}}]
+
+        for row in enrolled_users.aggregate(pipeline):
+            profiles = row.pop("profiles")
+            user = User._from_son(row)
+            if profiles:
+                user._profile = UserProfile._from_son(profiles[0])
+            users.append(user)
+        return users
+
+
+household_roster = HouseholdRosterCache()
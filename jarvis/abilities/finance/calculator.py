@@ -1,12 +1,17 @@
+import heapq
+from collections import defaultdict
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import Collection, Iterable
+from typing import Collection, Iterable, Hashable
 
+from bson import ObjectId
 from mongoengine import Q
 
+from jarvis.abilities.finance.caches import household_roster
 from jarvis.abilities.finance.models import Expense, Debt
-from jarvis.models import User, Features
+from jarvis.models import User
+from jarvis.utils import vocabularies
 
 
 class SharedFinancesCalculator:
@@ -33,17 +38,57 @@ class SharedFinancesCalculator:
         quota_of_total: Decimal = field(default=None)
         recurring_expenses: Decimal = field(default=None)
 
+    @dataclass
+    class Transfer:
+        debtor: User
+        creditor: User
+        amount: Decimal
+
+    @dataclass
+    class ExpenseTotals:
+        one_off: int = 0
+        shared: int = 0
+        private: int = 0
+        recurring: int = 0
+
     @classmethod
     def enrolled_usernames(cls):
         return list(cls.get_enrolled_users("username"))
 
     @classmethod
     def get_enrolled_users(cls, scalar=None) -> Collection[User]:
-        enrolled_users = User.objects(
-            enrolled_features__contains=Features.shared_finances.value)
+        enrolled_users = household_roster.get()
         if scalar is None:
-            return enrolled_users.all()
-        return enrolled_users.scalar(scalar).all()
+            return enrolled_users
+        return [getattr(user, scalar) for user in enrolled_users]
+
+    @classmethod
+    def get_expense_totals(cls,
+                           range_start: datetime,
+                           range_end: datetime = None
+                           ) -> dict[ObjectId, ExpenseTotals]:
+        """
+        Sums the expenses of every user in a single $group aggregation.
+        Recurring expenses are counted by their occurrences in the
+        period, written by Expense.objects.materialize_recurring().
+        """
+        if range_end is None:
+            range_end = datetime.now() + timedelta(days=1)
+
+        is_occurrence = {"$ifNull": ["$recurrence_of", False]}
+        one_off = {"$cond": [is_occurrence, 0, "$price"]}
+        pipeline = [{"$group": {
+            "_id": "$user_reference",
+            "one_off": {"$sum": one_off},
+            "shared": {"$sum": {"$cond": [{"$eq": ["$shared", True]}, one_off, 0]}},
+            "private": {"$sum": {"$cond": [{"$eq": ["$shared", False]}, one_off, 0]}},
+            "recurring": {"$sum": {"$cond": [is_occurrence, "$price", 0]}},
+        }}]
+        expenses = Expense.objects.within_period(range_start=range_start,
+                                                 range_end=range_end)
+
+        return {row.pop("_id"): cls.ExpenseTotals(**row)
+                for row in expenses.aggregate_with_archive(pipeline)}
 
     def calculate_split(self,
                         participant_users: Iterable[User],
@@ -55,21 +100,18 @@ class SharedFinancesCalculator:
         user taking part in the shared finances. Their gross
         salary is taken in to consideration when calculating.
         """
-        calculations, processed = [], []
-        recurring_expenses_sum = Expense.objects.recurring().sum("price")
-        total_sum = Decimal(
-            Expense.objects.within_period(
-                range_start,
-                range_end,
-                shared_only=True
-            ).sum("price"))
-
+        calculations = []
+        participant_users = list(participant_users)
+        totals_by_user = self.get_expense_totals(range_start, range_end)
+        recurring_expenses_sum = sum(i.recurring for i in totals_by_user.values())
+        total_sum = Decimal(sum(i.shared for i in totals_by_user.values()))
         total_sum += recurring_expenses_sum
 
         # Get the total combined income of all participants.
+        incomes = {user.pk: user.profile.gross_income
+                   for user in participant_users}
         try:
-            combined_income = Decimal(sum((user.profile.gross_income
-                                           for user in participant_users)))
+            combined_income = Decimal(sum(incomes.values()))
         except TypeError:
             raise ValueError("At least one user is missing a gross salary. "
                              "Calculations cannot proceed.")
@@ -79,16 +121,10 @@ class SharedFinancesCalculator:
         for user in participant_users:
             ingoing_compensation = outgoing_compensation = Decimal(0)
             calculation = self.SharedExpenseCalculation(user=user)
-            normal_expenses = Expense.objects.within_period(
-                user=user,
-                range_start=range_start,
-                range_end=range_end
-            ).sum("price")
-            recurring_expenses = Expense.objects.recurring(
-                user=user
-            ).sum("price")
-            paid_amount = Decimal(normal_expenses + recurring_expenses)
-            income_quotient = user.profile.gross_income / combined_income
+            totals = totals_by_user.get(user.pk, self.ExpenseTotals())
+            recurring_expenses = totals.recurring
+            paid_amount = Decimal(totals.one_off + recurring_expenses)
+            income_quotient = incomes[user.pk] / combined_income
             expected_paid_amount_based_on_income = total_sum * income_quotient
 
             if expected_paid_amount_based_on_income > paid_amount:
@@ -110,6 +146,83 @@ class SharedFinancesCalculator:
         self.total_expense_sum = total_sum
         return calculations
 
+    @classmethod
+    def get_debt_balances(cls) -> dict[ObjectId, Decimal]:
+        """
+        Returns the net balance of every user over all outstanding
+        debts, from a single aggregation. A positive balance means
+        that the user is owed money, a negative that they owe money.
+        """
+        pipeline = [
+            {"$project": {"entries": [
+                {"user": "$lender", "amount": "$amount"},
+                {"user": "$borrower", "amount": {"$multiply": ["$amount", -1]}},
+            ]}},
+            {"$unwind": "$entries"},
+            {"$group": {"_id": "$entries.user",
+                        "balance": {"$sum": "$entries.amount"}}},
+        ]
+        return {row["_id"]: Decimal(str(row["balance"]))
+                for row in Debt.objects.aggregate(pipeline)}
+
+    @staticmethod
+    def minimize_transfers(balances: dict[Hashable, Decimal]
+                           ) -> list[tuple[Hashable, Hashable, Decimal]]:
+        """
+        Greedy minimum cash flow: the user owing the most pays the
+        user who is owed the most, until everyone is settled. Returns
+        (debtor, creditor, amount) tuples, amounts rounded to cents.
+        """
+        cent = Decimal("0.01")
+        creditors, debtors, transfers = [], [], []
+
+        # The index breaks ties between equal amounts in the heaps
+        for i, (key, balance) in enumerate(balances.items()):
+            balance = Decimal(balance).quantize(cent)
+            if balance >= cent:
+                creditors.append((-balance, i, key))
+            elif balance <= -cent:
+                debtors.append((balance, i, key))
+        heapq.heapify(creditors)
+        heapq.heapify(debtors)
+
+        while creditors and debtors:
+            credit, creditor_index, creditor = heapq.heappop(creditors)
+            debt, debtor_index, debtor = heapq.heappop(debtors)
+            amount = min(-credit, -debt)
+            transfers.append((debtor, creditor, amount))
+
+            if (remaining_credit := -credit - amount) >= cent:
+                heapq.heappush(creditors, (-remaining_credit, creditor_index, creditor))
+            if (remaining_debt := -debt - amount) >= cent:
+                heapq.heappush(debtors, (-remaining_debt, debtor_index, debtor))
+        return transfers
+
+    def plan_settlement(self,
+                        include_split: bool = False,
+                        range_start: datetime = None,
+                        range_end: datetime = None) -> list[Transfer]:
+        """
+        Plans the smallest set of transfers which settles all
+        outstanding debts between users. Optionally, the compensations
+        from splitting the expenses in the period are settled as well.
+        """
+        balances = defaultdict(Decimal, self.get_debt_balances())
+        if include_split:
+            for calculation in self.calculate_split(self.get_enrolled_users(),
+                                                    range_start=range_start,
+                                                    range_end=range_end):
+                balances[calculation.user.pk] += (calculation.ingoing_compensation
+                                                  - calculation.outgoing_compensation)
+
+        transfers = self.minimize_transfers(balances)
+        users = User.objects.only("username").in_bulk(
+            [user_id for transfer in transfers for user_id in transfer[:2]])
+        return [self.Transfer(debtor=users[debtor],
+                              creditor=users[creditor],
+                              amount=amount)
+                for debtor, creditor, amount in transfers]
+
     @classmethod
     def balance_out_debts_for_buckets(cls,
                                       top_paying_bucket: SharedExpenseCalculation,
@@ -156,3 +269,7 @@ class SharedFinancesCalculator:
             deducted_debt = max(0, large_bucket_debt - small_bucket_debt)
             largest_debt_bucket.compensation_amount += deducted_debt
             return largest_debt_bucket
+
+
+# The usernames are matched in entities of the finance intents
+vocabularies.register("enrolled_usernames", SharedFinancesCalculator.enrolled_usernames)
@@ -0,0 +1,108 @@
+import csv
+from datetime import datetime, timedelta
+from io import TextIOWrapper
+from itertools import chain
+from tempfile import SpooledTemporaryFile
+from typing import Iterator
+
+import xlsxwriter
+
+from jarvis.abilities.finance.models import ArchivedExpense, BaseExpense, Expense
+from jarvis.models import User
+
+
+class ExpenseExporter:
+    """
+    Exports expenses to xlsx or CSV files, spooled to disk when large.
+
+    The expenses are read in batches from a cursor without a
+    result cache, and each row is written as it's read. Xlsx
+    files are written by xlsxwriter in 'constant_memory' mode,
+    which flushes every row to disk when the next one begins.
+    The files are written to a temporary file, which is only
+    held in memory while it's small. Memory use hence stays
+    flat, also for a ledger spanning several years.
+
+    The period includes all expenses on the 'range_end' date.
+    """
+    headers = ("Datum", "Utgift", "Belopp", "Användare", "Delad", "Återkommande")
+    fields = ("created", "expense_name", "price", "user_reference",
+              "shared", "recurrence_of")
+    date_format = "%Y-%m-%d %H:%M"
+    batch_size = 1000
+    max_memory_size = 1024 * 1024
+
+    def __init__(self, range_start: datetime = None, range_end: datetime = None):
+        self.range_start = range_start
+        self.range_end = range_end
+
+    def to_xlsx(self) -> SpooledTemporaryFile | None:
+        """
+        Write the expenses to an xlsx file. None if there are no
+        expenses to export.
+        """
+        if (rows := self._peek(self._rows())) is None:
+            return None
+
+        buffer = SpooledTemporaryFile(max_size=self.max_memory_size)
+        workbook = xlsxwriter.Workbook(buffer, {"constant_memory": True})
+        worksheet = workbook.add_worksheet()
+        bold = workbook.add_format({"bold": True})
+        worksheet.write_row(0, 0, self.headers, bold)
+
+        row_number = 0
+        for row_number, row in enumerate(rows, start=1):
+            worksheet.write_row(row_number, 0, row)
+        worksheet.write(row_number + 2, 0, "Totalt:", bold)
+        worksheet.write_formula(row_number + 2, 2, f"=SUM(C2:C{row_number + 1})", bold)
+        workbook.close()
+        buffer.seek(0)
+        return buffer
+
+    def to_csv(self) -> SpooledTemporaryFile | None:
+        """
+        Write the expenses to a CSV file, encoded with a BOM so that
+        it opens correctly in Excel. None if there are no expenses
+        to export.
+        """
+        if (rows := self._peek(self._rows())) is None:
+            return None
+
+        buffer = SpooledTemporaryFile(max_size=self.max_memory_size)
+        text_buffer = TextIOWrapper(buffer, encoding="utf-8-sig", newline="")
+        writer = csv.writer(text_buffer, delimiter=";")
+        writer.writerow(self.headers)
+        writer.writerows(rows)
+        text_buffer.flush()
+        text_buffer.detach()
+        buffer.seek(0)
+        return buffer
+
+    def _rows(self) -> Iterator[tuple]:
+        """
+        Yields the expenses in the period as rows, the archived ones
+        first.
+        """
+        usernames = dict(User.objects.scalar("id", "username"))
+        for expense in chain(self._read(ArchivedExpense), self._read(Expense)):
+            yield (expense["created"].strftime(self.date_format),
+                   expense["expense_name"],
+                   expense["price"],
+                   usernames.get(expense["user_reference"], "?").capitalize(),
+                   "Ja" if expense.get("shared", True) else "Nej",
+                   "Ja" if expense.get("recurrence_of") else "Nej")
+
+    def _read(self, model: type[BaseExpense]) -> Iterator[dict]:
+        # Recurring expenses are exported as their occurrences
+        expenses = model.objects.filter(recurring_monthly=False).order_by("created")
+        if self.range_start is not None:
+            expenses = expenses.filter(created__gte=self.range_start)
+        if self.range_end is not None:
+            expenses = expenses.filter(created__lt=self.range_end + timedelta(days=1))
+        return expenses.only(*self.fields).no_cache().as_pymongo().batch_size(self.batch_size)
+
+    @staticmethod
+    def _peek(rows: Iterator[tuple]) -> Iterator[tuple] | None:
+        if (first_row := next(rows, None)) is None:
+            return None
+        return chain([first_row], rows)
@@ -0,0 +1,173 @@
+import csv
+import re
+from bisect import bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, time
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from itertools import chain
+from typing import Iterable, Iterator
+
+import mongoengine as me
+
+from jarvis.abilities.finance.models import AccountingEntry, Expense, ExpenseLedger
+from jarvis.models import User
+
+
+class ExpenseImporter:
+    """
+    Imports expenses in bulk from CSV files, such as the
+    transaction exports from Swedish banks.
+
+    The file is parsed as a stream of lines. Each row is validated
+    against the Expense schema and the expenses are stored with
+    insert_many in batches. Each batch is booked in the ExpenseLedger,
+    in the accounting periods its expenses fall in.
+
+    Purchases are negative amounts in most bank exports, which is
+    why positive amounts (deposits, refunds) are skipped unless
+    'outgoing_only' is False.
+    """
+    date_columns = ("datum", "transaktionsdatum", "transaktionsdag",
+                    "bokföringsdag", "bokföringsdatum", "date")
+    name_columns = ("text", "beskrivning", "rubrik", "specifikation",
+                    "transaktion", "mottagare", "description")
+    amount_columns = ("belopp", "summa", "amount")
+    date_formats = ("%Y-%m-%d", "%Y/%m/%d", "%Y%m%d", "%d/%m/%Y", "%d.%m.%Y")
+    batch_size = 500
+
+    @dataclass
+    class Result:
+        imported: int = 0
+        skipped: int = 0
+        errors: list[str] = field(default_factory=list)
+
+    def __init__(self, user: User, shared: bool = True, outgoing_only: bool = True):
+        self.user = user
+        self.shared = shared
+        self.outgoing_only = outgoing_only
+
+    def import_lines(self, lines: Iterable[bytes | str]) -> Result:
+        """
+        Import expenses from the lines of a CSV file, with a header row.
+        """
+        result = self.Result()
+        batch = []
+        period_starts = [None, *AccountingEntry.objects.order_by("created").scalar("created")]
+        for row_number, row in self._read_rows(lines):
+            try:
+                if (expense := self._expense_from_row(row)) is None:
+                    result.skipped += 1
+                    continue
+                expense.validate()
+            except (ValueError, me.ValidationError) as e:
+                result.errors.append(f"Rad {row_number}: {e}")
+                continue
+
+            batch.append(expense)
+            if len(batch) >= self.batch_size:
+                result.imported += self._insert(batch, period_starts)
+        if batch:
+            result.imported += self._insert(batch, period_starts)
+        return result
+
+    @staticmethod
+    def _insert(batch: list[Expense], period_starts: list[datetime | None]) -> int:
+        """
+        Insert a batch of expenses, and book them in the periods they
+        fall in, given the start of each period in order.
+        """
+        Expense.objects.insert(batch, load_bulk=False)
+        expenses_by_period = defaultdict(list)
+        for expense in batch:
+            period = bisect_right(period_starts, expense.created, lo=1) - 1
+            expenses_by_period[period_starts[period]].append(expense)
+        for period_start, expenses in expenses_by_period.items():
+            ExpenseLedger.objects.book(*expenses, period_start=period_start)
+
+        inserted = len(batch)
+        batch.clear()
+        return inserted
+
+    def _read_rows(self, lines: Iterable[bytes | str]) -> Iterator[tuple[int, dict]]:
+        """
+        Yields the rows in the file as dicts with normalized column names.
+        """
+        lines = self._decode(lines)
+        if (header := next(lines, None)) is None:
+            return
+        try:
+            dialect = csv.Sniffer().sniff(header, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        # The reader joins quoted values which span several lines
+        reader = csv.reader(chain([header], lines), dialect)
+        columns = [column.strip().casefold() for column in next(reader)]
+
+        for values in reader:
+            if any(values):
+                yield reader.line_num, dict(zip(columns, values))
+
+    @staticmethod
+    def _decode(lines: Iterable[bytes | str]) -> Iterator[str]:
+        """
+        Bank exports are commonly encoded in cp1252 rather than utf-8.
+        Every line is ended with a newline, as the csv module expects,
+        also when the lines were split without them.
+        """
+        for line in lines:
+            if isinstance(line, bytes):
+                try:
+                    line = line.decode("utf-8-sig")
+                except UnicodeDecodeError:
+                    line = line.decode("cp1252")
+            yield line.lstrip("\ufeff").rstrip("\r\n") + "\n"
+
+    def _expense_from_row(self, row: dict) -> Expense | None:
+        """
+        Create an Expense from a row, or None if the row isn't an
+        expense.
+        :raise ValueError: The row is missing columns or has invalid values
+        """
+        date = self._get_column(row, self.date_columns)
+        name = self._get_column(row, self.name_columns)
+        amount = self._parse_amount(self._get_column(row, self.amount_columns))
+
+        if amount == 0 or (self.outgoing_only and amount > 0):
+            return None
+
+        # Noon keeps the date intact regardless of time zone
+        created = datetime.combine(self._parse_date(date), time(12))
+        return Expense(expense_name=name.strip()[:200],
+                       price=int(abs(amount).to_integral_value(ROUND_HALF_UP)),
+                       user_reference=self.user,
+                       created=created,
+                       shared=self.shared)
+
+    @staticmethod
+    def _get_column(row: dict, candidates: tuple[str]) -> str:
+        for column in candidates:
+            if row.get(column):
+                return row[column]
+        raise ValueError(f"saknar någon av kolumnerna {', '.join(candidates)}")
+
+    @staticmethod
+    def _parse_amount(value: str) -> Decimal:
+        """
+        Parse amounts such as '-1 234,50', '-1.234,50' and '-1234.50'.
+        """
+        value = re.sub(r"\s|kr|sek", "", value.casefold())
+        if "," in value:
+            value = value.replace(".", "").replace(",", ".")
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise ValueError(f"ogiltigt belopp: '{value}'")
+
+    def _parse_date(self, value: str):
+        for date_format in self.date_formats:
+            try:
+                return datetime.strptime(value.strip(), date_format).date()
+            except ValueError:
+                continue
+        raise ValueError(f"ogiltigt datum: '{value}'")
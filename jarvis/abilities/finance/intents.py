@@ -5,9 +5,10 @@ from pyttman.core.entity_parsing.fields import TextEntityField, \
     BoolEntityField, IntEntityField, StringEntityField
 from pyttman.core.intent import Intent
 
-from jarvis.abilities.finance.calculator import SharedFinancesCalculator
+from jarvis.abilities.finance.caches import household_roster
 from jarvis.abilities.finance.month import Month
 from jarvis.models import User
+from jarvis.utils import vocabularies
 
 
 class AddExpense(Intent):
@@ -15,15 +16,16 @@ class AddExpense(Intent):
     Add a shared expense.
     """
     lead = ("spara", "ny", "nytt", "new", "save", "store")
-    trail = ("utgift", "expense", "utlägg", "purchase")
+    trail = ("utgift", "utgifter", "expense", "utlägg", "purchase")
+    private_words = ("egen", "privat")
+    recurring_words = ("återkommande", "upprepande", "upprepad", "repeterande")
+    flag_words = private_words + recurring_words
 
     expense_name = TextEntityField(span=10, exclude=("för", "till"))
     expense_value = IntEntityField()
-    store_for_username = TextEntityField(valid_strings=SharedFinancesCalculator
-                                         .enrolled_usernames)
-    private = BoolEntityField(message_contains=("egen", "privat"))
-    recurring = BoolEntityField(message_contains=("återkommande", "upprepande",
-                                                  "upprepad", "repeterande"))
+    store_for_username = TextEntityField(valid_strings=vocabularies.provider("enrolled_usernames"))
+    private = BoolEntityField(message_contains=private_words)
+    recurring = BoolEntityField(message_contains=recurring_words)
 
     def respond(self, message: Message) -> Union[Reply, ReplyStream]:
         return self.ability.add_expense(message)
@@ -58,7 +60,7 @@ class GetExpenses(Intent):
     private_only = BoolEntityField(message_contains=("egna", "privata", "privat", "mina"))
     shared_only = BoolEntityField(message_contains=("delade", "delad"))
     username_for_query = TextEntityField(
-        valid_strings=SharedFinancesCalculator.enrolled_usernames)
+        valid_strings=vocabularies.provider("enrolled_usernames"))
     recurring_expenses_only = BoolEntityField(
         message_contains=("återkommande", "upprepande",
                           "upprepad", "repeterande"))
@@ -73,6 +75,78 @@ class GetExpenses(Intent):
         return self.ability.get_expenses(message)
 
 
+class GetNextExpensesPage(Intent):
+    """
+    Continues the most recent listing of expenses, showing
+    the next page of older expenses.
+    """
+    lead = ("nästa",)
+    trail = ("sida", "sidan")
+    example = "Nästa sida"
+
+    def respond(self, message: Message) -> Union[Reply, ReplyStream]:
+        return self.ability.get_next_expenses_page(message)
+
+
+class GetExpenseStatistics(Intent):
+    """
+    Returns statistics over the household's shared expenses:
+    totals month by month with a rolling average, each user's
+    share and the largest categories.
+    """
+    lead = ("statistik", "analys", "analysera")
+    description = "Visa statistik över hushållets delade utgifter, " \
+                  "månad för månad. Ange antal månader för att " \
+                  "begränsa perioden."
+    example = "Statistik för 12 månader"
+
+    months = IntEntityField()
+
+    def respond(self, message: Message) -> Union[Reply, ReplyStream]:
+        return self.ability.get_expense_statistics(message)
+
+
+class ImportExpenses(Intent):
+    """
+    Imports expenses in bulk from an attached CSV file, such
+    as a transaction export from the bank.
+    """
+    lead = ("importera",)
+    trail = ("utgift", "utgifter", "kontoutdrag", "fil")
+    description = "Importera utgifter från en bifogad CSV-fil, till " \
+                  "exempel en export av transaktioner från banken. " \
+                  "Köp i filen sparas som delade utgifter, om du " \
+                  "inte anger att de är privata."
+    example = "Importera utgifter från bifogad fil"
+
+    private = BoolEntityField(message_contains=("egen", "egna", "privat", "privata"))
+
+    def respond(self, message: Message) -> Union[Reply, ReplyStream]:
+        return self.ability.import_expenses(message)
+
+
+class ExportExpenses(Intent):
+    """
+    Exports the expenses in the current accounting period,
+    a given period or all expenses, to an xlsx or CSV file.
+    """
+    lead = ("exportera",)
+    trail = ("utgift", "utgifter", "utgiftslista")
+    description = "Exportera utgifterna till en Excel-fil, eller CSV. " \
+                  "Utan period exporteras nuvarande konteringsperiod. " \
+                  "Ange 'från' och 'till' med datum (ÅÅÅÅ-MM-DD) för " \
+                  "en annan period, eller 'alla' för samtliga utgifter."
+    example = "Exportera alla utgifter som csv"
+
+    period_start = StringEntityField(prefixes=("från", "from"))
+    period_end = StringEntityField(prefixes=("till", "to"))
+    all_expenses = BoolEntityField(message_contains=("alla", "allt", "samtliga"))
+    as_csv = BoolEntityField(message_contains=("csv",))
+
+    def respond(self, message: Message) -> Union[Reply, ReplyStream]:
+        return self.ability.export_expenses(message)
+
+
 class CalculateSplitExpenses(Intent):
     """
     This intent sums up a month's expenses
@@ -95,6 +169,22 @@ class CalculateSplitExpenses(Intent):
         return self.ability.calculate_split_expenses(message)
 
 
+class SimulateIncomeSplit(Intent):
+    """
+    Simulates how the split of the current period would change
+    with other incomes, or with a new member in the household.
+    """
+    lead = ("simulera",)
+    description = "Simulera fördelningen av nuvarande period med andra " \
+                  "inkomster. Ange namn och inkomst, eller ett intervall " \
+                  "av inkomster. Ange 'ny' och en inkomst för att lägga " \
+                  "till en ny medlem i hushållet."
+    example = "Simulera Simon 30000-50000 ny 25000"
+
+    def respond(self, message: Message) -> Reply | ReplyStream:
+        return self.ability.simulate_income_split(message)
+
+
 class EnterMonthlyIncome(Intent):
     """
     Allows users to enter an amount stored as their monthly
@@ -115,6 +205,7 @@ class EnterMonthlyIncome(Intent):
             message.user.profile.gross_income = income
             message.user.profile.save()
             message.user.save()
+            household_roster.invalidate()
             return Reply(f"Månadsinkomst sparad: {income}:- före skatt.")
 
         if current_income := message.user.profile.gross_income:
@@ -138,8 +229,7 @@ class AddDebt(Intent):
 
     author_is_borrower = BoolEntityField(message_contains=("jag", "i"))
     author_is_lender = BoolEntityField(message_contains=("ut", "mig", "me"))
-    other_person = TextEntityField(valid_strings=SharedFinancesCalculator
-                                   .enrolled_usernames)
+    other_person = TextEntityField(valid_strings=vocabularies.provider("enrolled_usernames"))
     amount = IntEntityField()
     comment = TextEntityField(span=10, prefixes=("för", "till"))
 
@@ -159,15 +249,35 @@ class GetDebts(Intent):
 
     author_is_borrower = BoolEntityField(message_contains=("jag", "i"))
     borrower_name = TextEntityField(
-        valid_strings=SharedFinancesCalculator.enrolled_usernames)
+        valid_strings=vocabularies.provider("enrolled_usernames"))
     individual = BoolEntityField(message_contains=("individuell",
                                                    "individuella",
                                                    "individuellt"))
+    page = IntEntityField(prefixes=("sida",))
 
     def respond(self, message: Message) -> Reply | ReplyStream:
         return self.ability.get_debts(message)
 
 
+class SettleDebts(Intent):
+    """
+    Plans how all outstanding debts between users can be
+    settled with as few transfers as possible.
+    """
+    description = "Räkna ut hur alla skulder kan regleras med så få " \
+                  "överföringar som möjligt. Ange 'utgifter' för att " \
+                  "även räkna med kompensationen från konteringen."
+    example = "Avräkna skulder och utgifter"
+    lead = ("avräkna", "avräkning", "nettoreglera")
+
+    include_expenses = BoolEntityField(message_contains=("utgifter",
+                                                         "kontering",
+                                                         "konteringen"))
+
+    def respond(self, message: Message) -> Reply | ReplyStream:
+        return self.ability.settle_debts(message)
+
+
 class RepayDebt(Intent):
     """
     Allows users to repay an outstanding compensation_amount to other users.
@@ -179,13 +289,33 @@ class RepayDebt(Intent):
 
     repaid_amount = IntEntityField()
     mentioned_user = TextEntityField(
-        valid_strings=SharedFinancesCalculator.enrolled_usernames)
+        valid_strings=vocabularies.provider("enrolled_usernames"))
     author_is_borrower = BoolEntityField(message_contains=("jag", "i"))
 
     def respond(self, message: Message) -> Reply | ReplyStream:
         return self.ability.repay_debt(message)
 
 
+class GetLastAccountingEntry(Intent):
+    """
+    Shows the most recently closed accounting period, with the
+    result for each participant - optionally compared with the
+    period before it.
+    """
+    lead = ("visa", "hämta")
+    trail = ("kontering", "konteringen", "konteringar")
+    description = "Visa resultatet från den senast stängda " \
+                  "konteringen. Skriv 'jämför' för att jämföra " \
+                  "med perioden innan."
+    example = "Visa förra konteringen och jämför"
+
+    compare = BoolEntityField(message_contains=("jämför", "jämföra", "jämfört",
+                                                "jämförelse"))
+
+    def respond(self, message: Message) -> Reply | ReplyStream:
+        return self.ability.get_last_accounting_entry(message)
+
+
 class UndoLastClosingCalculatedExpense(Intent):
     """
     This intent allows users to delete previously accounting records.
@@ -218,3 +348,21 @@ class UndoLastExpense(Intent):
         stream.put(Reply(f"Utgiften har raderats:"))
         stream.put(deleted_expense)
         return stream
+
+
+class EndRecurringExpense(Intent):
+    """
+    Ends one of the author's recurring expenses, so that it's
+    no longer charged in coming accounting periods.
+    """
+    lead = ("avsluta", "stoppa", "upphör")
+    trail = ("återkommande", "prenumeration", "abonnemang")
+    description = "Avsluta en återkommande utgift, till exempel ett " \
+                  "abonnemang. Den belastar nuvarande period men " \
+                  "inte kommande."
+    example = "Avsluta återkommande utgift Netflix"
+
+    expense_name = TextEntityField(span=5, exclude=("utgift", "utgiften"))
+
+    def respond(self, message: Message) -> Reply | ReplyStream:
+        return self.ability.end_recurring_expense(message)
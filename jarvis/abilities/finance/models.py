@@ -1,8 +1,10 @@
+from collections import defaultdict
 from datetime import datetime, timedelta
+from typing import Iterable
 
 import mongoengine as me
-import pandas
-from mongoengine import QuerySet
+from mongoengine import Q, QuerySet
+from pymongo import UpdateOne, UpdateMany, DeleteMany, InsertOne
 from pyttman import app
 
 from jarvis.abilities.finance.month import Month
@@ -20,22 +22,67 @@ class ExpenseQuerySet(QuerySet):
         Returns the most recently recorded Expense.
         :return:
         """
-        result = self.order_by("-created")
+        result = self.filter(recurrence_of=None).order_by("-created")
         if user is not None:
             result = result.filter(user_reference=user)
         return result.first()
 
-    def recurring(self, user: User = None) -> QuerySet:
+    def recurring(self, user: User = None, active_at: datetime = None) -> QuerySet:
         """
         Returns all recurring expenses.
         :param user: User owning the Expense documents
+        :param active_at: Only recurring expenses which haven't ended at this time
         :return: QuerySet[Expense]
         """
         query = self.filter(recurring_monthly=True)
         if user is not None:
             query = query.filter(user_reference=user)
+        if active_at is not None:
+            query = query.filter(Q(recurring_end=None) | Q(recurring_end__gt=active_at))
         return query
 
+    def materialize_recurring(self,
+                              period_start: datetime | None,
+                              period_end: datetime = None) -> int:
+        """
+        Write one occurrence of each recurring expense in this query
+        which is active in the period starting at period_start, and
+        book them in the ExpenseLedger.
+
+        Occurrences are one-off expenses referring to their recurring
+        expense, created at the start of the period - or when the
+        recurring expense was created, if that's later. Occurrences
+        which already exist are left as they are, which makes this
+        safe to run more than once for a period.
+        Returns the number of occurrences written.
+        """
+        if period_end is None:
+            period_end = datetime.utcnow()
+        operations = []
+        for expense in self.recurring().as_pymongo():
+            ended = expense.get("recurring_end")
+            if expense["created"] > period_end or (
+                    None not in (ended, period_start) and ended <= period_start):
+                continue
+            created = expense["created"] if period_start is None \
+                else max(expense["created"], period_start)
+            operations.append(UpdateOne(
+                {"recurrence_of": expense["_id"], "created": created},
+                {"$setOnInsert": {"expense_name": expense["expense_name"],
+                                  "price": expense["price"],
+                                  "user_reference": expense["user_reference"],
+                                  "shared": expense.get("shared", True),
+                                  "recurring_monthly": False}},
+                upsert=True))
+        if not operations:
+            return 0
+
+        result = self._collection.bulk_write(operations, ordered=False)
+        if occurrence_ids := list(result.upserted_ids.values()):
+            ExpenseLedger.objects.book(*Expense.objects(id__in=occurrence_ids),
+                                       period_start=period_start)
+        return len(occurrence_ids)
+
     def within_period(self,
                       range_start: datetime,
                       range_end: datetime = None,
@@ -63,8 +110,66 @@ class ExpenseQuerySet(QuerySet):
             query = query.filter(user_reference=user)
         return query
 
+    def aggregate_with_archive(self, pipeline: list[dict]) -> Iterable[dict]:
+        """
+        Run an aggregation over the expenses matching this query,
+        including the ones moved to the ArchivedExpense collection.
+        """
+        return self.aggregate([{"$unionWith": {
+            "coll": ArchivedExpense._get_collection_name(),
+            "pipeline": [{"$match": self._query}]}},
+            *pipeline])
+
+    def archive(self, before: datetime) -> int:
+        """
+        Move the one-off expenses created before 'before' to the
+        ArchivedExpense collection. Recurring expenses are never
+        archived, since they apply to every period.
+        Returns the number of expenses archived.
+        """
+        return move_documents(self.filter(created__lt=before, recurring_monthly=False),
+                              into=ArchivedExpense)
 
-class Expense(me.Document):
+    def archive_closed_periods(self, keep_periods: int = 2) -> int:
+        """
+        Archive the expenses from all but the last 'keep_periods'
+        accounting periods, including the current one. The default
+        keeps the last closed period, so that closing it can be undone.
+        Returns the number of expenses archived.
+        """
+        if (boundary := AccountingEntry.objects.order_by("-created").skip(
+                keep_periods - 1).scalar("created").first()) is None:
+            return 0
+        return self.archive(before=boundary)
+
+
+def move_documents(queryset: QuerySet,
+                   into: type[me.Document],
+                   batch_size: int = 1000) -> int:
+    """
+    Move the documents matching a query to the collection of another
+    model, a batch at a time in the order of their ids, with $merge
+    followed by a delete of the batch. Documents already in the target
+    collection are kept as they are, which makes an interrupted move
+    safe to run again.
+    Returns the number of documents moved.
+    :raise RuntimeError: None of the documents in a batch could be moved
+    """
+    moved = 0
+    remaining = queryset.order_by("id")
+    while batch := list(remaining.scalar("id").limit(batch_size)):
+        in_batch = queryset.filter(id__in=batch)
+        in_batch.aggregate([{"$merge": {"into": into._get_collection_name(),
+                                        "whenMatched": "keepExisting"}}])
+        if not (deleted := in_batch.delete()):
+            raise RuntimeError(f"Moving {len(batch)} documents to "
+                               f"{into.__name__} failed, none were removed.")
+        moved += deleted
+        remaining = queryset.order_by("id").filter(id__gt=batch[-1])
+    return moved
+
+
+class BaseExpense(me.Document):
     """
     This model represents an Expense made by a user.
     The expense is stored for the user who recorded it
@@ -80,7 +185,12 @@ class Expense(me.Document):
     account_for = me.DateField(default=lambda: datetime.utcnow())
     recurring_monthly = me.BooleanField(default=False)
     shared = me.BooleanField(default=True)
-    meta = {"queryset_class": ExpenseQuerySet}
+    # A recurring expense is charged once in every period from when
+    # it was created, until it ends
+    recurring_end = me.DateTimeField()
+    # The recurring expense which this expense is an occurrence of
+    recurrence_of = me.ReferenceField("Expense")
+    meta = {"abstract": True}
 
     def __str__(self):
         """
@@ -100,9 +210,127 @@ class Expense(me.Document):
         recurring = ""
         if self.recurring_monthly:
             recurring = ":repeat: **Upprepande**\n"
+            if self.recurring_end:
+                recurring += f":stop_sign: **Avslutas " \
+                             f"{self.recurring_end.strftime(self.output_date_format)}**\n"
         return name + price + created_date + account_month + recurring + shared + sep
 
 
+class Expense(BaseExpense):
+    """
+    The expenses in the current and most recent accounting
+    periods. Expenses in older, closed periods are moved to
+    ArchivedExpense.
+    """
+    meta = {
+        "queryset_class": ExpenseQuerySet,
+        "index_background": True,
+        "indexes": [
+            # within_period() for the household, and recurring()
+            ("recurring_monthly", "shared", "created"),
+            # within_period() and recurring() for a single user
+            ("user_reference", "recurring_monthly", "shared", "created"),
+            # latest(), with and without a user
+            ("user_reference", "-created"),
+            "-created",
+            # One occurrence of a recurring expense per period
+            {"fields": ("recurrence_of", "created"),
+             "unique": True,
+             "partialFilterExpression": {"recurrence_of": {"$exists": True}}},
+        ]
+    }
+
+
+class ArchivedExpenseQuerySet(QuerySet):
+    """
+    Custom metaclass for the QuerySetManager
+    used when querying the ArchivedExpense model.
+    """
+
+    def restore(self) -> int:
+        """
+        Move the archived expenses matching this query back to
+        the Expense collection. Returns the number restored.
+        """
+        return move_documents(self, into=Expense)
+
+
+class ArchivedExpense(BaseExpense):
+    """
+    One-off expenses from closed accounting periods, moved out of
+    the Expense collection to keep the working set of queries on
+    expenses to about one period. The per-period totals remain in
+    the ExpenseLedger.
+    """
+    meta = {
+        "queryset_class": ArchivedExpenseQuerySet,
+        "index_background": True,
+        "indexes": [
+            "created",
+            ("user_reference", "created"),
+        ]
+    }
+
+
+class DebtQuerySet(QuerySet):
+    """
+    Custom metaclass for the QuerySetManager
+    used when querying the Debt model.
+    """
+
+    def repay(self, borrower: User, lender: User, amount: float) -> tuple[float, float]:
+        """
+        Pays down the debts from borrower to lender by amount, the
+        smallest debt first. An amount exceeding the debts is booked
+        as a new debt in the opposite direction.
+
+        Each debt is reduced with its own $inc, so that concurrent
+        repayments compose: a debt which was repaid and deleted in
+        the meantime doesn't match, and its share of the amount goes
+        to the next debt, or to the overpayment. Should a concurrent
+        repayment drive a debt below zero, it's flipped to the other
+        direction instead of being lost. The clean-up is written in
+        one bulk_write.
+
+        Returns the overpaid amount and the remaining debt balance.
+        """
+        debts = self.filter(borrower=borrower, lender=lender)
+        remaining_amount = amount
+        outstanding_debt = 0.0
+
+        for debt in debts.order_by("amount").only("id", "amount").as_pymongo():
+            if remaining_amount <= 0:
+                outstanding_debt += debt["amount"]
+                continue
+            allocated_amount = min(debt["amount"], remaining_amount)
+            result = self._collection.update_one({"_id": debt["_id"]},
+                                                 {"$inc": {"amount": -allocated_amount}})
+            if result.matched_count:
+                outstanding_debt += debt["amount"]
+                remaining_amount -= allocated_amount
+
+        between = {"borrower": borrower.pk, "lender": lender.pk}
+        operations = [
+            # Debts which are repaid; less than half an öre is rounding.
+            # Negative debts are left to be flipped, also when they're
+            # driven below zero by a concurrent repayment in between.
+            DeleteMany({**between, "amount": {"$gt": -0.005, "$lt": 0.005}}),
+            UpdateMany({**between, "amount": {"$lt": 0}}, [
+                {"$set": {"borrower": "$lender",
+                          "lender": "$borrower",
+                          "amount": {"$multiply": ["$amount", -1]}}}]),
+        ]
+        if remaining_amount > 0:
+            overpayment = self._document(borrower=lender,
+                                         lender=borrower,
+                                         amount=remaining_amount)
+            operations.append(InsertOne(overpayment.to_mongo()))
+
+        self._collection.bulk_write(operations, ordered=True)
+        repaid_amount = amount - remaining_amount
+        return max(0.0, remaining_amount), max(0.0, outstanding_debt - repaid_amount)
+
+
 class Debt(me.Document):
     """
     An outstanding compensation_amount from one user to another.
@@ -115,6 +343,14 @@ class Debt(me.Document):
     amount: float = me.FloatField(default=0.0)
     created: datetime = me.DateTimeField(default=lambda: datetime.now())
     comment = me.StringField(required=False)
+    meta = {
+        "queryset_class": DebtQuerySet,
+        "index_background": True,
+        "indexes": [
+            ("borrower", "lender", "amount"),
+            "lender",
+        ]
+    }
 
     def __str__(self):
         """
@@ -129,6 +365,65 @@ class Debt(me.Document):
         return lender + amount + comment + sep
 
 
+class AccountingSnapshot(me.EmbeddedDocument):
+    """
+    One participant's part of a closed accounting period, as
+    calculated when the period was closed. The username is
+    stored along with the reference, so that snapshots can
+    be displayed without dereferencing the users.
+    """
+    user = me.ReferenceField(User, required=True)
+    username = me.StringField(required=True)
+    paid_amount = me.DecimalField(precision=2, default=0)
+    recurring_expenses = me.DecimalField(precision=2, default=0)
+    expected_paid_amount = me.DecimalField(precision=2, default=0)
+    income_quotient = me.DecimalField(precision=4, default=0)
+    quota_of_total = me.DecimalField(precision=4, default=0)
+    ingoing_compensation = me.DecimalField(precision=2, default=0)
+    outgoing_compensation = me.DecimalField(precision=2, default=0)
+
+    @classmethod
+    def from_calculation(cls, calculation) -> "AccountingSnapshot":
+        """
+        Create a snapshot from a SharedExpenseCalculation.
+        """
+        return cls(user=calculation.user,
+                   username=calculation.user.username,
+                   paid_amount=calculation.paid_amount,
+                   recurring_expenses=calculation.recurring_expenses or 0,
+                   expected_paid_amount=calculation.expected_paid_amount_based_on_income,
+                   income_quotient=calculation.income_quotient,
+                   quota_of_total=calculation.quota_of_total,
+                   ingoing_compensation=calculation.ingoing_compensation or 0,
+                   outgoing_compensation=calculation.outgoing_compensation or 0)
+
+    def as_str(self, total_expense_sum) -> str:
+        """
+        UI friendly string, for easy visualization in chat.
+        :return: str
+        """
+        username = self.username.capitalize()
+        msg = f"\n:moneybag: **{username}:**\n"
+        msg += f"**Summa:** {self.paid_amount:.2f}:- \n" \
+               f"**Belastning:** {self.quota_of_total * 100:.2f}% av " \
+               f"totalen {total_expense_sum:.2f}:-.\n"
+        if self.recurring_expenses:
+            msg += f"**Varav återkommande utgifter:** {self.recurring_expenses:.2f}:- \n"
+
+        msg += f"**Månadslön:** {self.income_quotient * 100:.2f}% av den " \
+               f"totala inkomsten av deltagarna.\n"
+
+        if self.ingoing_compensation:
+            msg += f"**Ska kompenseras med:** {self.ingoing_compensation:.2f}:- från övriga " \
+                   f"deltagare."
+        elif self.outgoing_compensation:
+            msg += f"**Ska kompensera andra med** {self.outgoing_compensation:.2f}:-"
+        else:
+            msg += f"**{username} har betalat exakt sin kvot och ska varken " \
+                   f"kompenseras eller kompensera andra."
+        return msg
+
+
 class AccountingEntry(me.Document):
     """
     This model represents an accounting performed by
@@ -139,7 +434,146 @@ class AccountingEntry(me.Document):
     Whenever a report is created by the user, the data
     is returned and then stored in this document for
     later retrieval.
+
+    The period and each participant's result are stored as
+    structured snapshots. Entries created before snapshots
+    were introduced only hold the rendered 'accounting_result'.
     """
     participants: list[User] = me.ListField(me.ReferenceField(User, required=True))
     accounting_result: str = me.StringField(required=True)
     created = me.DateTimeField(default=lambda: datetime.utcnow())
+    period_start = me.DateTimeField(null=True)
+    period_end = me.DateTimeField()
+    total_expense_sum = me.DecimalField(precision=2, default=0)
+    snapshots = me.EmbeddedDocumentListField(AccountingSnapshot)
+    meta = {
+        "index_background": True,
+        "indexes": ["-created"]
+    }
+
+
+class ExpenseLedgerQuerySet(QuerySet):
+    """
+    Custom metaclass for the QuerySetManager
+    used when querying the ExpenseLedger model.
+    """
+
+    def for_period(self, period_start: datetime | None) -> QuerySet:
+        """
+        Returns the ledger rows for the period starting at period_start.
+        """
+        return self.filter(period_start=period_start)
+
+    def book(self,
+             *expenses: Expense,
+             period_start: datetime | None,
+             revert: bool = False) -> None:
+        """
+        Adds the price of expenses to the running totals of their
+        users in the period, with one atomic $inc per user.
+        Provide revert=True when the expenses are deleted.
+        """
+        increments = defaultdict(lambda: defaultdict(int))
+        for expense in expenses:
+            # to_mongo() gives us the referenced ids without dereferencing
+            son = expense.to_mongo()
+            if son.get("recurrence_of"):
+                column = "recurring"
+            elif expense.shared:
+                column = "shared"
+            else:
+                column = "private"
+            user_id = son["user_reference"]
+            increments[user_id][column] += -expense.price if revert else expense.price
+
+        for user_id, columns in increments.items():
+            self.for_period(period_start).filter(user_reference=user_id).update_one(
+                upsert=True, **{f"inc__{column}": amount
+                                for column, amount in columns.items()})
+
+    def merge_period(self,
+                     period_start: datetime,
+                     into_period_start: datetime | None) -> None:
+        """
+        Merge the totals of a period back in to the period before it,
+        when the accounting entry which started it is deleted.
+        """
+        for row in self.for_period(period_start):
+            self.for_period(into_period_start).filter(
+                user_reference=row.to_mongo()["user_reference"]
+            ).update_one(upsert=True,
+                         inc__shared=row.shared,
+                         inc__private=row.private,
+                         inc__recurring=row.recurring)
+        self.for_period(period_start).delete()
+
+    def rebuild(self) -> int:
+        """
+        Recompute all ledger rows from the raw expenses, one period
+        at a time. Returns the number of rows written.
+
+        The rows are upserted in place, and rows which no longer have
+        any expenses are deleted, in one bulk_write. The ledger is
+        hence never empty while it's rebuilt, and rows booked in the
+        meantime don't collide with the ones written here.
+        """
+        boundaries = [None, *AccountingEntry.objects.order_by("created").scalar("created")]
+        one_off = {"$cond": [{"$ifNull": ["$recurrence_of", False]}, 0, "$price"]}
+        operations = [DeleteMany({"period_start": {"$nin": boundaries}})]
+        rows_written = 0
+
+        for period_start, period_end in zip(boundaries, boundaries[1:] + [None]):
+            expenses = Expense.objects.filter(recurring_monthly=False)
+            if period_start is not None:
+                expenses = expenses.filter(created__gte=period_start)
+            if period_end is not None:
+                expenses = expenses.filter(created__lt=period_end)
+
+            user_ids = []
+            for row in expenses.aggregate_with_archive([
+                {"$group": {
+                    "_id": "$user_reference",
+                    "shared": {"$sum": {"$cond": [{"$eq": ["$shared", True]}, one_off, 0]}},
+                    "private": {"$sum": {"$cond": [{"$eq": ["$shared", False]}, one_off, 0]}},
+                    "recurring": {"$sum": {"$cond": [{"$ifNull": ["$recurrence_of", False]},
+                                                     "$price", 0]}},
+                }}]):
+                user_ids.append(user_id := row.pop("_id"))
+                operations.append(UpdateOne({"period_start": period_start,
+                                             "user_reference": user_id},
+                                            {"$set": row},
+                                            upsert=True))
+            operations.append(DeleteMany({"period_start": period_start,
+                                          "user_reference": {"$nin": user_ids}}))
+            rows_written += len(user_ids)
+
+        self._collection.bulk_write(operations, ordered=True)
+        return rows_written
+
+
+class ExpenseLedger(me.Document):
+    """
+    Running totals of the expenses for each user and accounting
+    period, maintained as expenses are created and deleted.
+
+    This allows the budget and sums for the current period to be
+    read without summing all expenses in it. The ledger can be
+    recomputed from the raw expenses with
+    jarvis/abilities/finance/scripts/rebuild_ledger.py.
+    """
+    user_reference = me.ReferenceField(User, required=True)
+    period_start = me.DateTimeField(null=True)
+    shared = me.IntField(default=0)
+    private = me.IntField(default=0)
+    recurring = me.IntField(default=0)
+    meta = {
+        "queryset_class": ExpenseLedgerQuerySet,
+        "index_background": True,
+        "indexes": [
+            {"fields": ("period_start", "user_reference"), "unique": True},
+        ]
+    }
+
+    @property
+    def total(self) -> int:
+        return self.shared + self.private + self.recurring
@@ -0,0 +1,18 @@
+from jarvis.abilities.finance.models import ArchivedExpense, Expense
+
+if __name__ == "__main__":
+    # Move expenses from closed accounting periods to the archive, or
+    # restore them. The ExpenseLedger totals are unaffected either way.
+    action = input("Archive or restore expenses? (a/r) ").strip().casefold()
+
+    if action == "a":
+        keep_periods = input("Number of periods to keep, including "
+                             "the current one (default 2): ")
+        archived = Expense.objects.archive_closed_periods(int(keep_periods or 2))
+        print(f"Archived {archived} expenses.")
+    elif action == "r":
+        restored = ArchivedExpense.objects.restore()
+        print(f"Restored {restored} expenses.")
+    else:
+        print("Unknown action:", action)
+        exit(-1)
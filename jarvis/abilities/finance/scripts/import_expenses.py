@@ -0,0 +1,22 @@
+from jarvis.abilities.finance.importer import ExpenseImporter
+from jarvis.models import User
+
+if __name__ == "__main__":
+    # Import expenses in bulk from a CSV file, such as a transaction
+    # export from the bank. Purchases are the negative amounts in it.
+    file_path = input("Path to the CSV file: ")
+    username = input("Which user made the purchases? ")
+    shared = input("Are the expenses shared? (y/n) ").strip().casefold() != "n"
+
+    if (user := User.objects.from_username_or_alias(username)) is None:
+        print("User not found:", username)
+        exit(-1)
+
+    importer = ExpenseImporter(user=user, shared=shared)
+    with open(file_path, "rb") as file:
+        result = importer.import_lines(file)
+
+    print(f"Imported {result.imported} expenses for {user.username}, "
+          f"skipped {result.skipped} deposits.")
+    for error in result.errors:
+        print(error)
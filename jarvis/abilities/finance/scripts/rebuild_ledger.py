@@ -0,0 +1,8 @@
+from jarvis.abilities.finance.models import ExpenseLedger
+
+if __name__ == "__main__":
+    # Recompute the running totals in the ExpenseLedger from the raw
+    # expenses, e.g. after expenses were changed outside of Jarvis.
+    print("Rebuilding the expense ledger...")
+    rows_written = ExpenseLedger.objects.rebuild()
+    print(f"Done. Wrote {rows_written} ledger rows.")
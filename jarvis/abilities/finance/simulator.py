@@ -0,0 +1,102 @@
+from datetime import datetime
+from typing import Iterable
+
+import numpy
+
+from jarvis.abilities.finance.calculator import SharedFinancesCalculator
+from jarvis.models import User
+
+
+class IncomeSplitSimulator:
+    """
+    Simulates how the split of a period's expenses would change
+    with other incomes, or with another participant.
+
+    The expense totals of the period are read once. Each income
+    scenario is a row in an (S, U) matrix of S scenarios for U
+    participants, and all scenarios are evaluated in one vectorized
+    computation - the same split as SharedFinancesCalculator
+    .calculate_split(), without querying the database again.
+    """
+
+    def __init__(self,
+                 participants: Iterable[str],
+                 incomes: Iterable[float],
+                 paid: Iterable[float],
+                 total_expense_sum: float):
+        self.participants = list(participants)
+        self.incomes = numpy.asarray(incomes, dtype=float)
+        self.paid = numpy.asarray(paid, dtype=float)
+        self.total_expense_sum = float(total_expense_sum)
+
+    @classmethod
+    def for_period(cls,
+                   participant_users: Iterable[User],
+                   range_start: datetime,
+                   range_end: datetime = None) -> "IncomeSplitSimulator":
+        """
+        Read the expense totals and incomes for the participants
+        in a period.
+        :raise ValueError: A participant is missing a gross income
+        """
+        participant_users = list(participant_users)
+        totals_by_user = SharedFinancesCalculator.get_expense_totals(range_start, range_end)
+        total_expense_sum = sum(totals.shared + totals.recurring
+                                for totals in totals_by_user.values())
+
+        incomes, paid = [], []
+        for user in participant_users:
+            if (income := user.profile.gross_income) is None:
+                raise ValueError(f"{user.username} is missing a gross salary.")
+            totals = totals_by_user.get(user.pk, SharedFinancesCalculator.ExpenseTotals())
+            incomes.append(income)
+            paid.append(totals.one_off + totals.recurring)
+        return cls(participants=[user.username for user in participant_users],
+                   incomes=incomes,
+                   paid=paid,
+                   total_expense_sum=total_expense_sum)
+
+    def with_participant(self, name: str, income: float, paid: float = 0) -> "IncomeSplitSimulator":
+        """
+        A simulator with another participant in the household.
+        """
+        return IncomeSplitSimulator(participants=self.participants + [name],
+                                    incomes=numpy.append(self.incomes, income),
+                                    paid=numpy.append(self.paid, paid),
+                                    total_expense_sum=self.total_expense_sum + paid)
+
+    def scenarios(self, participant: int, incomes: Iterable[float]) -> numpy.ndarray:
+        """
+        An (S, U) matrix of income scenarios, where the income of
+        one participant takes each of the given values while the
+        others keep their current income.
+        """
+        incomes = numpy.asarray(incomes, dtype=float)
+        scenarios = numpy.tile(self.incomes, (len(incomes), 1))
+        scenarios[:, participant] = incomes
+        return scenarios
+
+    def compensations(self, incomes: numpy.ndarray = None) -> numpy.ndarray:
+        """
+        The (S, U) compensation matrix for the income scenarios. For
+        each scenario and participant, the amount they should pay the
+        others - or, when negative, receive from them.
+        """
+        incomes = numpy.atleast_2d(self.incomes if incomes is None else incomes)
+        income_quotients = incomes / incomes.sum(axis=1, keepdims=True)
+        return self.total_expense_sum * income_quotients - self.paid
+
+    def break_even_income(self, participant: int, incomes: numpy.ndarray) -> float | None:
+        """
+        The income within the given incomes at which a participant
+        would neither pay nor receive any compensation. None if
+        there's no such income in the range.
+        """
+        incomes = numpy.asarray(incomes, dtype=float)
+        compensations = self.compensations(self.scenarios(participant, incomes))[:, participant]
+        if not compensations.min() <= 0 <= compensations.max():
+            return None
+        # The compensation increases with the participant's own income,
+        # and numpy.interp needs it in increasing order
+        order = numpy.argsort(compensations)
+        return float(numpy.interp(0, compensations[order], incomes[order]))
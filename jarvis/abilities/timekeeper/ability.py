@@ -12,6 +12,7 @@ from pyttman.core.containers import Message, Reply, ReplyStream
 
 import jarvis.abilities.timekeeper.intents as intents
 from jarvis.abilities.timekeeper.models import WorkShift, Project
+from jarvis.utils import vocabularies
 
 
 class TimeKeeper(Ability):
@@ -127,6 +128,7 @@ class TimeKeeper(Ability):
             return Reply("Det finns redan ett projekt med det namnet.")
         project = Project.objects.create(name=project_name.casefold(),
                                          hourly_rate=hourly_rate)
+        vocabularies.invalidate("project_names")
         return Reply(f"Grattis till ditt nya projekt: '{project}'!")
 
     @classmethod
@@ -158,7 +160,7 @@ class TimeKeeper(Ability):
             return Reply("Du har inte angivit något giltigt projekt, och "
                          "det fanns inget standardprojekt att välja. "
                          "Du kan välja mellan "
-                         f"{', '.join(Project.all_project_names())}.")
+                         f"{', '.join(vocabularies.get('project_names'))}.")
 
         base_reply_string = "Totalt har du jobbat in {} timmar {} i projekt {}"
         sum_for_today = message.entities["sum_for_today"]
@@ -239,6 +241,7 @@ class TimeKeeper(Ability):
         project: Project | Reply = cls.get_project_by_name(project_name)
         project.is_active = True
         project.save()
+        vocabularies.invalidate("project_names")
         return Reply(f"Projekt {project.name} är nu aktivt.")
 
     @classmethod
@@ -250,6 +253,7 @@ class TimeKeeper(Ability):
         project: Project | Reply = cls.get_project_by_name(project_name)
         project.is_active = False
         project.save()
+        vocabularies.invalidate("project_names")
         return Reply(f"Projekt {project.name} är nu inaktivt.")
 
     @classmethod
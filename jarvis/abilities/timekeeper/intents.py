@@ -11,6 +11,7 @@ from jarvis.abilities.finance.month import Month
 from jarvis.abilities.timekeeper.models import WorkShift, Project
 from jarvis.custom_identifiers import TimeStampIdentifier
 from jarvis.models import User
+from jarvis.utils import vocabularies
 
 
 class CreateWorkShift(Intent):
@@ -18,7 +19,7 @@ class CreateWorkShift(Intent):
     Starts a WorkShift or an Intermission.
     """
     exact_match = ("jag", "börjar", "jobba")
-    project_name = StringEntityField(valid_strings=Project.all_project_names)
+    project_name = StringEntityField(valid_strings=vocabularies.provider("project_names"))
 
     def respond(self, message: Message) -> Reply | ReplyStream:
         project_name = message.entities["project_name"]
@@ -69,7 +70,7 @@ class GetWorkShift(Intent):
     sum_for_today = BoolEntityField(message_contains=("idag", "idag?"))
     sum_for_month = BoolEntityField(message_contains=("månad", "månaden",
                                                       "månad?", "månaden?"))
-    project_name = StringEntityField(valid_strings=Project.all_project_names)
+    project_name = StringEntityField(valid_strings=vocabularies.provider("project_names"))
 
     def respond(self, message: Message) -> Reply | ReplyStream:
         return self.ability.get_worked_hours(message)
@@ -88,7 +89,7 @@ class CreateWorkShiftFromString(Intent):
     to_datetime = StringEntityField(identifier=DateTimeStringIdentifier)
     from_timestamp = StringEntityField(identifier=TimeStampIdentifier)
     to_timestamp = StringEntityField(identifier=TimeStampIdentifier)
-    project_name = StringEntityField(valid_strings=Project.all_project_names)
+    project_name = StringEntityField(valid_strings=vocabularies.provider("project_names"))
     until_now = BoolEntityField(message_contains=("nu",))
 
     def respond(self, message: Message) -> Reply | ReplyStream:
@@ -121,7 +122,7 @@ class SetProjectAsDefault(Intent):
     """
     lead = ("projekt", "sätt")
     trail = ("default", "standard", "standardprojekt")
-    project_name = StringEntityField(valid_strings=Project.all_project_names)
+    project_name = StringEntityField(valid_strings=vocabularies.provider("project_names"))
 
     def respond(self, message: Message) -> Reply | ReplyStream:
         return self.ability.set_project_as_default(message)
@@ -133,7 +134,7 @@ class ActivateProject(Intent):
     """
     lead = ("aktivera",)
     trail = ("projekt",)
-    project_name = StringEntityField(valid_strings=Project.all_project_names,
+    project_name = StringEntityField(valid_strings=vocabularies.provider("project_names"),
                                      span=5)
 
     def respond(self, message: Message) -> Reply | ReplyStream:
@@ -146,7 +147,7 @@ class DeactivateProject(Intent):
     """
     lead = ("avaktivera", "deaktivera", "pensionera", "inaktivera")
     trail = ("projekt",)
-    project_name = StringEntityField(valid_strings=Project.all_project_names,
+    project_name = StringEntityField(valid_strings=vocabularies.provider("project_names"),
                                      span=5)
 
     def respond(self, message: Message) -> Reply | ReplyStream:
@@ -174,7 +175,7 @@ class ExportWorkShiftsToFile(Intent):
     Export workshifts to an xlsx file.
     """
     exact_match = ("exportera", "arbetspass",)
-    project_name = StringEntityField(valid_strings=Project.all_project_names)
+    project_name = StringEntityField(valid_strings=vocabularies.provider("project_names"))
     month = StringEntityField(valid_strings=Month.names_as_list())
     year = IntEntityField()
 
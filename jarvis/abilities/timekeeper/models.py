@@ -5,6 +5,7 @@ import mongoengine as me
 
 from jarvis.abilities.timekeeper.querysets import ProjectQuerySet, WorkShiftQuerySet
 from jarvis.models import User
+from jarvis.utils import vocabularies
 
 
 class Project(me.Document):
@@ -28,8 +29,8 @@ class Project(me.Document):
         Get the raw property 'name' of all projects, as well
         as how they're presented in the application by __str__.
         """
-        names = list(cls.objects.all().scalar("name"))
-        presentable_names = [str(i) for i in cls.objects.all()]
+        names = list(cls.objects.scalar("name"))
+        presentable_names = [name.capitalize() for name in names]
         return tuple(names + presentable_names)
 
 
@@ -38,7 +39,15 @@ class WorkShift(me.Document):
     the WorkShift model holds a period in time for a user.
     StopWatch instances have a beginning and an end.
     """
-    meta = {"queryset_class": WorkShiftQuerySet}
+    meta = {
+        "queryset_class": WorkShiftQuerySet,
+        "index_background": True,
+        "indexes": [
+            ("user", "year", "month", "day", "project"),
+            ("user", "is_active"),
+            ("project", "year", "month"),
+        ]
+    }
     user = me.ReferenceField(User, required=True)
     beginning = me.DateTimeField(default=None, null=True)
     end = me.DateTimeField(default=None, null=True)
@@ -87,3 +96,7 @@ class WorkShift(me.Document):
         self.beginning = datetime.now()
         self.is_active = True
         self.save()
+
+
+# The project names are matched in entities of the timekeeper intents
+vocabularies.register("project_names", Project.all_project_names)
@@ -1,40 +1,427 @@
-import functools
+import heapq
+import math
+import multiprocessing
 import os
+import re
+import threading
+import traceback
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass
 
+import numpy
 import pyttman
 from fernet import Fernet
+from pyttman_base_plugin import PyttmanPlugin
 
 from jarvis.models import RAGMemory
 
 
+class MemoryIndex:
+    """
+    An in-memory BM25 index over the memories of an author, for
+    finding the memories most relevant to a message. Memories are
+    indexed as they're added, without rebuilding the index.
+    """
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, memories: list[str] = ()):
+        self.memories: list[str] = []
+        self.size = 0
+        self._term_frequencies: list[Counter] = []
+        self._lengths: list[int] = []
+        self._document_frequencies = Counter()
+        self._total_length = 0
+        for memory in memories:
+            self.add(memory)
+
+    def add(self, memory: str) -> None:
+        terms = self.tokenize(memory)
+        term_frequencies = Counter(terms)
+        self._document_frequencies.update(term_frequencies.keys())
+        self._term_frequencies.append(term_frequencies)
+        self._lengths.append(len(terms))
+        self._total_length += len(terms)
+        self.size += len(memory.encode("utf-8"))
+        self.memories.append(memory)
+
+    def top(self, query: str, k: int) -> list[str]:
+        """
+        The k memories most relevant to the query, in the order they
+        were stored. Ties are won by the most recent memories, so
+        that these are returned when nothing in the query matches.
+        """
+        if len(self.memories) <= k:
+            return list(self.memories)
+
+        query_terms = set(self.tokenize(query))
+        document_count = len(self.memories)
+        average_length = self._total_length / document_count or 1
+        idf = {term: math.log(1 + (document_count - frequency + 0.5) / (frequency + 0.5))
+               for term in query_terms
+               if (frequency := self._document_frequencies[term])}
+
+        def score(i: int) -> tuple[float, int]:
+            term_frequencies = self._term_frequencies[i]
+            length_norm = self.k1 * (1 - self.b + self.b * self._lengths[i] / average_length)
+            return sum(weight * term_frequencies[term] * (self.k1 + 1)
+                       / (term_frequencies[term] + length_norm)
+                       for term, weight in idf.items()
+                       if term in term_frequencies), i
+
+        return [self.memories[i] for i in sorted(heapq.nlargest(k, range(document_count), key=score))]
+
+    @staticmethod
+    def tokenize(text: str) -> list[str]:
+        return re.findall(r"\w+", text.casefold())
+
+
+class MemoryCache:
+    """
+    Indexed memories, cached by author. Each author is cached and
+    invalidated separately, so that one author storing a memory
+    doesn't throw away the memories of everyone else.
+
+    The cache is bounded by the size of the memories it holds. When
+    it's full, the memories of the least recently used authors are
+    evicted.
+    """
+
+    def __init__(self, max_bytes: int = 4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._indexes: OrderedDict[str, MemoryIndex] = OrderedDict()
+        self._size = 0
+
+    def get(self, key: str) -> MemoryIndex | None:
+        with self._lock:
+            if (index := self._indexes.get(key)) is not None:
+                self._indexes.move_to_end(key)
+            return index
+
+    def put(self, key: str, index: MemoryIndex) -> None:
+        with self._lock:
+            self._discard(key)
+            if index.size > self.max_bytes:
+                return
+            self._indexes[key] = index
+            self._size += index.size
+            self._evict()
+
+    def append(self, key: str, memory: str) -> None:
+        """
+        Add a memory for an author, if their memories are cached.
+        """
+        with self._lock:
+            if (index := self._indexes.get(key)) is None:
+                return
+            size = index.size
+            index.add(memory)
+            self._size += index.size - size
+            self._indexes.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, key: str = None) -> None:
+        """
+        Drop the memories of an author, or of all authors if no
+        key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._indexes.clear()
+                self._size = 0
+            else:
+                self._discard(key)
+
+    def _discard(self, key: str) -> None:
+        if (index := self._indexes.pop(key, None)) is not None:
+            self._size -= index.size
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes:
+            _, index = self._indexes.popitem(last=False)
+            self._size -= index.size
+
+
+class MemoryStore:
+    """
+    Encrypts and decrypts the memories stored in MongoDB, with a
+    Fernet instance which is created once, from the key in the
+    DPKEY environment variable.
+
+    The fernet package is implemented in pure Python, so threads
+    can't decrypt in parallel. Authors with many memories are
+    instead decrypted in batches, in a pool of worker processes
+    which each hold a Fernet instance of their own.
+    """
+    parallel_threshold = 512
+    batch_size = 256
+    max_workers = min(4, os.cpu_count() or 1)
+
+    def __init__(self):
+        self._fernet = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def fernet(self) -> Fernet:
+        # The key is read on first use, since .env is loaded after import
+        if self._fernet is None:
+            self._fernet = Fernet(self._key())
+        return self._fernet
+
+    def encrypt(self, memory: str) -> str:
+        return self.fernet.encrypt(memory.encode("utf-8")).decode("utf-8")
+
+    def decrypt(self, tokens: list[str]) -> list[str]:
+        """
+        Decrypt memories, keeping their order.
+        """
+        if len(tokens) < self.parallel_threshold:
+            return [self.fernet.decrypt(token.encode("utf-8")).decode("utf-8")
+                    for token in tokens]
+        batches = [tokens[i:i + self.batch_size]
+                   for i in range(0, len(tokens), self.batch_size)]
+        return [memory
+                for batch in self._get_executor().map(_decrypt_batch, batches)
+                for memory in batch]
+
+    def memories(self, author_key: str) -> list[str]:
+        """
+        Read and decrypt all memories of an author. Only the memory
+        field is read, without creating any documents.
+        """
+        tokens = list(RAGMemory.objects(author_key=author_key).no_cache().scalar("memory"))
+        return self.decrypt(tokens)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking the threaded bot process is unsafe, hence 'spawn'
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_decrypt_worker,
+                    initargs=(self._key(),))
+            return self._executor
+
+    @staticmethod
+    def _key() -> bytes:
+        return os.environ["DPKEY"].encode()
+
+
+_worker_fernet: Fernet | None = None
+
+
+def _init_decrypt_worker(key: bytes) -> None:
+    global _worker_fernet
+    _worker_fernet = Fernet(key)
+
+
+def _decrypt_batch(tokens: list[str]) -> list[str]:
+    return [_worker_fernet.decrypt(token.encode("utf-8")).decode("utf-8")
+            for token in tokens]
+
+
+class MemoryCompactor:
+    """
+    Removes near-duplicate memories, which accumulate as users
+    repeat themselves.
+
+    Each memory is shingled into character n-grams and given a
+    MinHash signature. Memories sharing a band of their signature
+    are candidates, and candidates whose shingles are at least
+    'similarity_threshold' similar are clustered. The most recent
+    memory of each cluster is kept, as it's the most up to date,
+    and the others are deleted.
+    """
+    shingle_size = 5
+    num_hashes = 64
+    bands = 16
+    similarity_threshold = 0.8
+    _prime = (1 << 31) - 1
+
+    @dataclass
+    class Result:
+        memories: int = 0
+        removed: int = 0
+        bytes_saved: int = 0
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+        rng = numpy.random.default_rng(seed=0)
+        self._a = rng.integers(1, self._prime, size=(self.num_hashes, 1), dtype=numpy.int64)
+        self._b = rng.integers(0, self._prime, size=(self.num_hashes, 1), dtype=numpy.int64)
+
+    def compact_all(self) -> Result:
+        result = self.Result()
+        for author_key in RAGMemory.objects.distinct("author_key"):
+            author_result = self.compact(author_key)
+            result.memories += author_result.memories
+            result.removed += author_result.removed
+            result.bytes_saved += author_result.bytes_saved
+        return result
+
+    def compact(self, author_key: str) -> Result:
+        """
+        Remove the near-duplicate memories of an author.
+        """
+        ids, tokens = [], []
+        for memory_id, token in RAGMemory.objects(author_key=author_key).order_by("created").scalar("id", "memory"):
+            ids.append(memory_id)
+            tokens.append(token)
+        result = self.Result(memories=len(ids))
+        if len(ids) < 2:
+            return result
+
+        duplicates = self.duplicates(self.store.decrypt(tokens))
+        if duplicates:
+            RAGMemory.objects(id__in=[ids[i] for i in duplicates]).delete()
+            memory_cache.invalidate(author_key)
+        result.removed = len(duplicates)
+        result.bytes_saved = sum(len(tokens[i]) for i in duplicates)
+        return result
+
+    def duplicates(self, memories: list[str]) -> list[int]:
+        """
+        The positions of the memories which are near-duplicates of a
+        later memory in the list.
+        """
+        shingles = [self.shingle(memory) for memory in memories]
+        signatures = [self.signature(memory_shingles) for memory_shingles in shingles]
+        rows = self.num_hashes // self.bands
+
+        clusters = list(range(len(memories)))
+
+        def find(i: int) -> int:
+            while clusters[i] != i:
+                clusters[i] = clusters[clusters[i]]
+                i = clusters[i]
+            return i
+
+        buckets = {}
+        for i, signature in enumerate(signatures):
+            for band in range(self.bands):
+                key = (band, signature[band * rows:(band + 1) * rows].tobytes())
+                for j in buckets.setdefault(key, []):
+                    if find(i) != find(j) and self.similarity(shingles[i], shingles[j]) >= self.similarity_threshold:
+                        # The later memory represents the cluster
+                        clusters[find(j)] = find(i)
+                buckets[key].append(i)
+        return [i for i in range(len(memories)) if find(i) != i]
+
+    def shingle(self, memory: str) -> set[int]:
+        text = " ".join(re.findall(r"\w+", memory.casefold()))
+        return {zlib.crc32(text[i:i + self.shingle_size].encode("utf-8"))
+                for i in range(max(1, len(text) - self.shingle_size + 1))}
+
+    def signature(self, shingles: set[int]) -> numpy.ndarray:
+        hashes = numpy.fromiter(shingles, dtype=numpy.int64, count=len(shingles))
+        return ((self._a * hashes + self._b) % self._prime).min(axis=1)
+
+    @staticmethod
+    def similarity(first: set[int], second: set[int]) -> float:
+        return len(first & second) / len(first | second)
+
+
+class MemoryQueryPlugin(PyttmanPlugin):
+    """
+    Makes the message being answered available to
+    mongo_get_memories, which is only given the author, so that
+    the memories relevant to the message can be picked out.
+
+    Place it before the OpenAIPlugin which uses the memories, with
+    the same intercept points.
+    """
+
+    def no_intent_match(self, message):
+        current_query.set(message.as_str())
+        return message
+
+
+
+class MemoryCompactionPlugin(PyttmanPlugin):
+    """
+    Compacts the memories of all authors in the background, every
+    'interval_hours' while the app runs. Running it in the app
+    rather than as a script lets the compaction invalidate the
+    memories in the app's cache.
+
+    Allow it to intercept before_app_start and after_app_stops.
+    """
+
+    def __init__(self, interval_hours: float = 24, **kwargs):
+        super().__init__(**kwargs)
+        self.interval_hours = interval_hours
+        self._stopped = threading.Event()
+
+    def before_app_start(self, app):
+        threading.Thread(target=self._compact_periodically, daemon=True).start()
+        return app
+
+    def after_app_stops(self, app):
+        self._stopped.set()
+        return app
+
+    def _compact_periodically(self) -> None:
+        compactor = MemoryCompactor(memory_store)
+        while not self._stopped.wait(self.interval_hours * 3600):
+            try:
+                result = compactor.compact_all()
+                pyttman.logger.log(f" - Compacted memories: removed {result.removed} "
+                                   f"of {result.memories}, saving {result.bytes_saved} bytes")
+            except Exception:
+                pyttman.logger.log("Compacting memories failed: "
+                                   f"{traceback.format_exc()}", "error")
+
+# The maximum number of memories given to the LLM with a message
+memories_top_k = 25
+
+current_query: ContextVar[str | None] = ContextVar("current_query", default=None)
+memory_cache = MemoryCache()
+memory_store = MemoryStore()
+
+
 # OpenAI RAG callbacks, connecting it to the database.
-@functools.lru_cache(maxsize=256)
 def mongo_get_memories(key: any):
     """
-    Get all memories from MongoDB for a given key.
+    Get the memories for a given key which are the most relevant
+    to the current message, or all of them if there's none.
     The memory content is decrypted before returning.
     """
-    pyttman.logger.log(" - Getting memories from MongoDB")
-    fernet = Fernet(os.environ["DPKEY"].encode())
-    return [
-        fernet.decrypt(memory.memory.encode("utf-8")).decode("utf-8")
-        for memory in RAGMemory.objects(author_key=str(key))
-    ]
+    if (index := memory_cache.get(str(key))) is None:
+        pyttman.logger.log(" - Getting memories from MongoDB")
+        index = MemoryIndex(memory_store.memories(str(key)))
+        memory_cache.put(str(key), index)
+
+    if (query := current_query.get()) is None:
+        return list(index.memories)
+    return index.top(query, k=memories_top_k)
 
 def mongo_add_memory(key: any, memory: str):
     """
     Store a new memory in MongoDB. The memory content is encrypted.
     """
-    fernet = Fernet(os.environ["DPKEY"].encode())
-    encrypted_memory = fernet.encrypt(memory.encode("utf-8"))
-    encrypted_memory = encrypted_memory.decode("utf-8")
-    RAGMemory(author_key=str(key), memory=encrypted_memory).save()
-    mongo_get_memories.cache_clear()
+    RAGMemory(author_key=str(key), memory=memory_store.encrypt(memory)).save()
+    memory_cache.append(str(key), memory)
 
-def mongo_purge_all_memories(*_):
-    for memory in RAGMemory.objects.all():
-        memory.delete()
+def mongo_purge_all_memories(*_) -> int:
+    """
+    Delete the memories of all authors, in a single query.
+    Returns the number of memories deleted.
+    """
+    deleted = RAGMemory.objects.delete()
+    memory_cache.invalidate()
+    return deleted
 
-def mongo_purge_memories(key: any):
-    for memory in RAGMemory.objects(author_key=key):
-        memory.delete()
+def mongo_purge_memories(key: any) -> int:
+    """
+    Delete the memories for a given key, in a single query.
+    Returns the number of memories deleted.
+    """
+    deleted = RAGMemory.objects(author_key=str(key)).delete()
+    memory_cache.invalidate(str(key))
+    return deleted
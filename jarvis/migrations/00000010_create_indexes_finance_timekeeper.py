@@ -0,0 +1,26 @@
+from pymongo.errors import OperationFailure
+
+from jarvis.abilities.finance.models import Expense, Debt, AccountingEntry
+from jarvis.abilities.timekeeper.models import WorkShift
+
+__doc__ = "Build the declared indexes for Expense, Debt, AccountingEntry and WorkShift in the background."
+
+models = (Expense, Debt, AccountingEntry, WorkShift)
+
+
+def upgrade():
+    for model in models:
+        model.ensure_indexes()
+        print(f"Ensured {len(model._meta['index_specs'])} indexes "
+              f"for {model.__name__}.")
+
+
+def downgrade():
+    for model in models:
+        collection = model._get_collection()
+        for index_spec in model._meta["index_specs"]:
+            try:
+                collection.drop_index(index_spec["fields"])
+            except OperationFailure as e:
+                print(f"Failed to drop index {index_spec['fields']} "
+                      f"for {model.__name__}: {e}")
@@ -0,0 +1,12 @@
+from jarvis.abilities.finance.models import ExpenseLedger
+
+__doc__ = "Build the ExpenseLedger running totals from all existing expenses."
+
+
+def upgrade():
+    rows_written = ExpenseLedger.objects.rebuild()
+    print(f"Wrote {rows_written} ledger rows.")
+
+
+def downgrade():
+    ExpenseLedger.drop_collection()
@@ -0,0 +1,21 @@
+from jarvis.abilities.finance.models import AccountingEntry, Expense, \
+    ExpenseLedger
+
+__doc__ = "Write an occurrence of each recurring expense for every accounting period since it was created, and rebuild the ExpenseLedger from them."
+
+
+def upgrade():
+    Expense.ensure_indexes()
+    boundaries = [None, *AccountingEntry.objects.order_by("created").scalar("created")]
+    written = 0
+    for period_start, period_end in zip(boundaries, boundaries[1:] + [None]):
+        written += Expense.objects.materialize_recurring(period_start, period_end)
+    print(f"Wrote {written} occurrences of recurring expenses.")
+    rows_written = ExpenseLedger.objects.rebuild()
+    print(f"Rebuilt the expense ledger with {rows_written} rows.")
+
+
+def downgrade():
+    deleted = Expense.objects(recurrence_of__ne=None).delete()
+    Expense.objects(recurring_end__ne=None).update(unset__recurring_end=True)
+    print(f"Deleted {deleted} occurrences of recurring expenses.")
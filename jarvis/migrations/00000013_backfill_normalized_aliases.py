@@ -0,0 +1,27 @@
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from jarvis.models import User
+
+__doc__ = "Backfill User.normalized_aliases from the aliases, and index it."
+
+
+def upgrade():
+    operations = [
+        UpdateOne({"_id": user["_id"]},
+                  {"$set": {"normalized_aliases": [User.normalize_alias(alias)
+                                                   for alias in user["aliases"]]}})
+        for user in User.objects(aliases__exists=True).only("aliases").as_pymongo()
+    ]
+    if operations:
+        User._get_collection().bulk_write(operations, ordered=False)
+    User.ensure_indexes()
+    print(f"Backfilled normalized aliases for {len(operations)} users.")
+
+
+def downgrade():
+    User.objects.update(unset__normalized_aliases=True)
+    try:
+        User._get_collection().drop_index([("normalized_aliases", 1)])
+    except OperationFailure as e:
+        print(f"Failed to drop index on normalized_aliases: {e}")
@@ -2,9 +2,11 @@ import enum
 from datetime import datetime, UTC
 from decimal import Decimal
 import mongoengine as me
-from mongoengine import QuerySet
+from mongoengine import Q, QuerySet
 from pyttman.core.containers import Message
 
+from jarvis.utils import ExpiringLRUCache
+
 
 class MigrationVersion(me.Document):
     """
@@ -14,6 +16,12 @@ class MigrationVersion(me.Document):
     version = me.IntField(required=True, default=0)
 
 
+# The ids of the users resolved from the authors of messages, by the
+# raw author id. Cleared whenever a User is saved, as its aliases may
+# have changed.
+user_identity_cache = ExpiringLRUCache(max_size=64, ttl_seconds=300)
+
+
 class UserQuerySet(QuerySet):
     """
     Custom metaclass for User queries
@@ -27,9 +35,27 @@ class UserQuerySet(QuerySet):
 
     def from_alias(self, alias: str):
         """
-        Get a user by one of their aliases.
+        Get a user by one of their aliases, matched exactly but
+        regardless of case on the indexed, normalized aliases.
+        """
+        return self.filter(normalized_aliases=User.normalize_alias(alias)).first()
+
+    def from_author(self, author_id):
+        """
+        Get the User for the author of a message, by the raw author
+        id. Used by the MongoEnginePlugin to bind 'message.user'.
+
+        The id of the user is cached for each author, so that repeated
+        messages from the same author are resolved by _id rather than
+        by alias. Each message still gets a User document of its own,
+        loaded fresh from the database.
         """
-        return self.filter(aliases__icontains=alias).first()
+        if (user_id := user_identity_cache.get(author_id)) is not None:
+            if (user := self.filter(id=user_id).first()) is not None:
+                return user
+        if (user := self.from_alias(author_id)) is not None:
+            user_identity_cache.put(author_id, user.id)
+        return user
 
     def from_username_or_alias(self, name: str):
         """
@@ -38,7 +64,13 @@ class UserQuerySet(QuerySet):
         If both alias and username should match, username supersedes
         aliases since it's an absolute identifier.
         """
-        return self.from_username(username=name) or self.from_alias(name)
+        # Not limited, as several users may share an alias
+        candidates = list(self.filter(Q(username=name)
+                                      | Q(normalized_aliases=User.normalize_alias(name))))
+        for user in candidates:
+            if user.username == name:
+                return user
+        return candidates[0] if candidates else None
 
     def from_message(self, message: Message):
         """
@@ -95,7 +127,13 @@ class User(me.Document):
     _profile = me.ReferenceField(UserProfile, null=True)
     username = me.StringField(required=True, unique=True)
     aliases = me.ListField(me.DynamicField())
-    meta = {"queryset_class": UserQuerySet}
+    # Maintained from 'aliases' on save, for indexed lookups
+    normalized_aliases = me.ListField(me.StringField())
+    meta = {
+        "queryset_class": UserQuerySet,
+        "index_background": True,
+        "indexes": ["normalized_aliases"],
+    }
     enrolled_features = me.ListField(me.IntField())
     weight_entries = me.ListField(me.ReferenceField("WeightEntry"))
 
@@ -108,6 +146,22 @@ class User(me.Document):
     def feature_enabled(self, feature: Features) -> bool:
         return feature.value in self.enrolled_features
 
+    def save(self, *args, **kwargs):
+        user = super().save(*args, **kwargs)
+        user_identity_cache.invalidate()
+        return user
+
+    def clean(self):
+        self.normalized_aliases = [self.normalize_alias(alias) for alias in self.aliases]
+
+    @staticmethod
+    def normalize_alias(alias) -> str:
+        """
+        Aliases are matched regardless of case and surrounding
+        whitespace. Discord ids may be stored as integers.
+        """
+        return str(alias).strip().casefold()
+
 class RAGMemory(me.Document):
     """
     This model is used to store memories for LLM RAG.
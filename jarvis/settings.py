@@ -8,7 +8,8 @@ from pyttman_base_plugin import PyttmanPlugin
 from pyttman_mongoengine_plugin import MongoEnginePlugin
 from pyttman_openai_plugin.plugin import OpenAIPlugin
 
-from jarvis.app import mongo_purge_all_memories, mongo_purge_memories, mongo_add_memory, mongo_get_memories
+from jarvis.app import mongo_purge_all_memories, mongo_purge_memories, mongo_add_memory, mongo_get_memories, \
+    MemoryCompactionPlugin, MemoryQueryPlugin
 from jarvis.models import User
 
 load_dotenv()
@@ -62,7 +63,7 @@ PLUGINS = [
         password=os.getenv("MONGO_DB_PASSWORD"),
         user_binding=MongoEnginePlugin.MessageUserBinding(
             user_model_class=User,
-            custom_queryset_method_name="from_alias",
+            custom_queryset_method_name="from_author",
         ),
         allowed_intercepts=[
             MongoEnginePlugin.PluginInterceptPoint.before_app_start,
@@ -70,6 +71,20 @@ PLUGINS = [
             MongoEnginePlugin.PluginInterceptPoint.before_intent
         ]
     ),
+    # Removes near-duplicate memories daily, invalidating them in the memory cache
+    MemoryCompactionPlugin(
+        interval_hours=24,
+        allowed_intercepts=[
+            PyttmanPlugin.PluginInterceptPoint.before_app_start,
+            PyttmanPlugin.PluginInterceptPoint.after_app_stops,
+        ],
+    ),
+    # Gives the memory callbacks the message, before the OpenAIPlugin asks for memories
+    MemoryQueryPlugin(
+        allowed_intercepts=[
+            PyttmanPlugin.PluginInterceptPoint.no_intent_match,
+        ],
+    ),
     OpenAIPlugin(
         api_key=os.environ["OPENAI_API_KEY"],
         system_prompt=os.environ["OPENAI_SYSTEM_PROMPT"],
@@ -1,12 +1,19 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import patch
 
-from pyttman.core.containers import Message
+import numpy
+from pyttman.core.containers import Message, Reply
 from pyttman.testing import PyttmanTestCase
 
 from jarvis.abilities.finance.ability import FinanceAbility
+from jarvis.abilities.finance.caches import household_roster
 from jarvis.abilities.finance.calculator import SharedFinancesCalculator
-from jarvis.abilities.finance.models import Expense
+from jarvis.abilities.finance.importer import ExpenseImporter
+from jarvis.abilities.finance.models import AccountingSnapshot, Debt, DebtQuerySet, \
+    Expense, ExpenseLedger
+from jarvis.abilities.finance.simulator import IncomeSplitSimulator
 from jarvis.models import User, Features
 
 
@@ -50,6 +57,7 @@ class TestSharedFinancesCalculator(PyttmanTestCase):
         self.test_user_4 = test_user_4
 
         self.calculator = SharedFinancesCalculator()
+        household_roster.invalidate()
 
     def _get_enrolled_test_users_in_finance(self):
         for user in self.calculator.get_enrolled_users():
@@ -99,6 +107,7 @@ class TestSharedFinancesCalculator(PyttmanTestCase):
         # Now test with another high earner, with equally high expenses
         self.test_user_4.enrolled_features.append(Features.shared_finances.value)
         self.test_user_4.save()
+        household_roster.invalidate()
         Expense(expense_name="test", price=1000, user_reference=self.test_user_4).save()
         enrolled_users = list(self._get_enrolled_test_users_in_finance())
         self.assertIn(self.test_user_4.id, [i.id for i in enrolled_users])
@@ -122,9 +131,62 @@ class TestSharedFinancesCalculator(PyttmanTestCase):
                 self.assertEqual(calculation.ingoing_compensation, Decimal(257.14))
                 break
 
+    def test_get_expense_totals(self):
+        range_start = datetime.utcnow() - timedelta(days=1)
+        Expense(expense_name="test", price=1000, user_reference=self.test_user_1).save()
+        Expense(expense_name="test", price=300, user_reference=self.test_user_1,
+                shared=False).save()
+        Expense(expense_name="test", price=200, user_reference=self.test_user_1,
+                recurring_monthly=True).save()
+        Expense(expense_name="test", price=500, user_reference=self.test_user_2).save()
+
+        # Recurring expenses are counted by their occurrence in the period
+        self.assertEqual(1, Expense.objects.materialize_recurring(range_start))
+        self.assertEqual(0, Expense.objects.materialize_recurring(range_start))
+
+        totals = self.calculator.get_expense_totals(range_start)
+        for user in (self.test_user_1, self.test_user_2):
+            expenses = Expense.objects.within_period(range_start=range_start, user=user)
+            expected_one_off = expenses.filter(recurrence_of=None).sum("price")
+            expected_recurring = expenses.filter(recurrence_of__ne=None).sum("price")
+            self.assertEqual(expected_one_off, totals[user.pk].one_off)
+            self.assertEqual(expected_recurring, totals[user.pk].recurring)
+
+        self.assertEqual(1000, totals[self.test_user_1.pk].shared)
+        self.assertEqual(300, totals[self.test_user_1.pk].private)
+
+    def test_add_several_expenses(self):
+        message = Message("spara utgifter mat 450, bensin 600",
+                          entities={"store_for_username": "test_user_1",
+                                    "expense_name": "mat",
+                                    "expense_value": 450})
+        self.ability.add_expense(message)
+        expenses = Expense.objects(user_reference=self.test_user_1)
+        self.assertEqual([("bensin", 600), ("mat", 450)],
+                         sorted((expense.expense_name, expense.price) for expense in expenses))
+
+    def test_add_several_expenses_with_invalid_segment(self):
+        message = Message("spara utgifter mat 450, bensin sexhundra",
+                          entities={"store_for_username": "test_user_1",
+                                    "expense_name": "mat",
+                                    "expense_value": 450})
+        reply = self.ability.add_expense(message)
+        self.assertIn("bensin sexhundra", reply.as_str())
+        self.assertEqual(0, Expense.objects(user_reference=self.test_user_1).count())
+
+    def test_add_invalid_expense(self):
+        message = Message("spara utgift glass -5",
+                          entities={"store_for_username": "test_user_1",
+                                    "expense_name": "glass",
+                                    "expense_value": -5})
+        reply = self.ability.add_expense(message)
+        self.assertIsInstance(reply, Reply)
+        self.assertEqual(0, Expense.objects(user_reference=self.test_user_1).count())
+
     def test_calculate_split_expenses(self):
         self.test_user_4.enrolled_features.append(Features.shared_finances.value)
         self.test_user_4.save()
+        household_roster.invalidate()
         Expense(expense_name="test", price=1000, user_reference=self.test_user_4).save()
         Expense(expense_name="test", price=1000, user_reference=self.test_user_3).save()
 
@@ -138,3 +200,240 @@ class TestSharedFinancesCalculator(PyttmanTestCase):
             print(reply.get().as_str())
         self.assertEqual(expected_rows, actual_rows)
 
+
+class TestDebtRepayment(PyttmanTestCase):
+    devmode = True
+
+    def setUp(self) -> None:
+        self.tearDown()
+        self.borrower = User(username="test_borrower")
+        self.borrower.save()
+        self.lender = User(username="test_lender")
+        self.lender.save()
+        Debt(borrower=self.borrower, lender=self.lender, amount=100).save()
+        Debt(borrower=self.borrower, lender=self.lender, amount=50).save()
+
+    def tearDown(self) -> None:
+        users = list(User.objects(username__in=["test_borrower", "test_lender"]))
+        Debt.objects(borrower__in=users).delete()
+        User.objects(id__in=[user.id for user in users]).delete()
+
+    @staticmethod
+    def _debts(borrower: User, lender: User) -> list[float]:
+        return sorted(Debt.objects(borrower=borrower, lender=lender).scalar("amount"))
+
+    def test_partial_repayment(self):
+        self.assertEqual((0.0, 90.0), Debt.objects.repay(self.borrower, self.lender, 60))
+
+        # The smallest debt is paid off first
+        self.assertEqual([90.0], self._debts(self.borrower, self.lender))
+        self.assertEqual([], self._debts(self.lender, self.borrower))
+
+    def test_exact_repayment(self):
+        self.assertEqual((0.0, 0.0), Debt.objects.repay(self.borrower, self.lender, 150))
+        self.assertEqual([], self._debts(self.borrower, self.lender))
+        self.assertEqual([], self._debts(self.lender, self.borrower))
+
+    def test_overpayment(self):
+        self.assertEqual((50.0, 0.0), Debt.objects.repay(self.borrower, self.lender, 200))
+
+        # The overpaid amount is owed back to the borrower
+        self.assertEqual([], self._debts(self.borrower, self.lender))
+        self.assertEqual([50.0], self._debts(self.lender, self.borrower))
+
+    def test_repayment_of_concurrently_repaid_debts(self):
+        # The debts are read, then repaid and deleted by someone else
+        stale_debts = list(Debt.objects(borrower=self.borrower)
+                           .order_by("amount").only("id", "amount").as_pymongo())
+        Debt.objects(borrower=self.borrower).delete()
+
+        with patch.object(DebtQuerySet, "as_pymongo", return_value=stale_debts):
+            overpaid, remaining = Debt.objects.repay(self.borrower, self.lender, 150)
+
+        # Nothing was left to repay, so all of it is owed back
+        self.assertEqual((150.0, 0.0), (overpaid, remaining))
+        self.assertEqual([150.0], self._debts(self.lender, self.borrower))
+
+
+class TestExpenseLedger(PyttmanTestCase):
+    devmode = True
+
+    def setUp(self) -> None:
+        self.tearDown()
+        self.user = User(username="test_ledger_user")
+        self.user.save()
+        self.period_start = datetime(2024, 1, 25)
+        self.next_period_start = datetime(2024, 2, 25)
+
+    def tearDown(self) -> None:
+        users = list(User.objects(username="test_ledger_user"))
+        ExpenseLedger.objects(user_reference__in=users).delete()
+        Expense.objects(user_reference__in=users).delete()
+        User.objects(id__in=[user.id for user in users]).delete()
+
+    def _totals(self, period_start: datetime) -> tuple[int, int, int]:
+        row = ExpenseLedger.objects.for_period(period_start).get(user_reference=self.user)
+        return row.shared, row.private, row.recurring
+
+    def test_book_and_revert(self):
+        shared = Expense(expense_name="mat", price=450, user_reference=self.user)
+        private = Expense(expense_name="glass", price=30, user_reference=self.user, shared=False)
+        ExpenseLedger.objects.book(shared, private, shared, period_start=self.period_start)
+        self.assertEqual((900, 30, 0), self._totals(self.period_start))
+
+        ExpenseLedger.objects.book(shared, period_start=self.period_start, revert=True)
+        self.assertEqual((450, 30, 0), self._totals(self.period_start))
+
+    def test_book_recurring_occurrence(self):
+        template = Expense(expense_name="hyra", price=8000, user_reference=self.user,
+                           recurring_monthly=True)
+        template.save()
+        occurrence = Expense(expense_name="hyra", price=8000, user_reference=self.user,
+                             recurrence_of=template)
+        ExpenseLedger.objects.book(occurrence, period_start=self.period_start)
+        self.assertEqual((0, 0, 8000), self._totals(self.period_start))
+
+    def test_merge_period(self):
+        ExpenseLedger.objects.book(
+            Expense(expense_name="mat", price=100, user_reference=self.user),
+            period_start=self.period_start)
+        ExpenseLedger.objects.book(
+            Expense(expense_name="mat", price=50, user_reference=self.user),
+            Expense(expense_name="glass", price=20, user_reference=self.user, shared=False),
+            period_start=self.next_period_start)
+
+        ExpenseLedger.objects.merge_period(self.next_period_start,
+                                           into_period_start=self.period_start)
+        self.assertEqual((150, 20, 0), self._totals(self.period_start))
+        self.assertEqual(0, ExpenseLedger.objects.for_period(self.next_period_start)
+                         .filter(user_reference=self.user).count())
+
+
+class TestDebtSettlement(TestCase):
+
+    def test_minimize_transfers(self):
+        balances = {"a": Decimal(300), "b": Decimal(-100),
+                    "c": Decimal(-150), "d": Decimal(-50), "e": Decimal(0)}
+        transfers = SharedFinancesCalculator.minimize_transfers(balances)
+
+        # Everyone owing money pays the single creditor directly
+        self.assertEqual(3, len(transfers))
+        self.assertEqual(Decimal(300), sum(amount for *_, amount in transfers))
+        self.assertTrue(all(creditor == "a" for _, creditor, _ in transfers))
+
+        # The net balance of every user is settled by the transfers
+        for user, balance in balances.items():
+            received = sum(a for _, creditor, a in transfers if creditor == user)
+            paid = sum(a for debtor, _, a in transfers if debtor == user)
+            self.assertEqual(balance, received - paid)
+
+
+class TestExpenseImporter(TestCase):
+
+    def test_read_bank_export(self):
+        lines = ["Bokföringsdag;Transaktionsdag;Text;Belopp;Saldo\n",
+                 "2024-03-02;2024-03-01;ICA MAXI;-1 234,50;10 000,00\n",
+                 "2024-03-03;2024-03-03;LÖN;25 000,00;35 000,00\n",
+                 "2024-03-04;2024-03-04;SL;-970;34 030,00\n",
+                 "\n",
+                 "2024-13-04;2024-13-04;FEL;-10;0\n"]
+        importer = ExpenseImporter(user=User(username="test_user"))
+        rows = list(importer._read_rows(line.encode("cp1252") for line in lines))
+
+        expenses = [importer._expense_from_row(row) for _, row in rows[:3]]
+        self.assertEqual(["ICA MAXI", None, "SL"],
+                         [e and e.expense_name for e in expenses])
+        self.assertEqual(1235, expenses[0].price)
+        self.assertEqual(datetime(2024, 3, 1, 12), expenses[0].created)
+
+        # Empty lines are skipped, the row number is kept for errors
+        row_number, row = rows[3]
+        self.assertEqual(6, row_number)
+        with self.assertRaises(ValueError):
+            importer._expense_from_row(row)
+
+    def test_read_quoted_value_spanning_lines(self):
+        # Lines as from requests' iter_lines(), without line endings
+        lines = [b"Datum,Text,Belopp",
+                 b'2024-03-01,"ICA MAXI',
+                 b'Kvitto 123",-100',
+                 b"2024-03-02,SL,-970"]
+        importer = ExpenseImporter(user=User(username="test_user"))
+        rows = list(importer._read_rows(lines))
+
+        self.assertEqual([3, 4], [row_number for row_number, _ in rows])
+        self.assertEqual("ICA MAXI\nKvitto 123", rows[0][1]["text"])
+        self.assertEqual("SL", rows[1][1]["text"])
+
+
+class TestAccountingSnapshot(TestCase):
+
+    def test_from_calculation(self):
+        calculation = SharedFinancesCalculator.SharedExpenseCalculation(
+            user=User(username="test_user"),
+            income_quotient=Decimal("0.6"),
+            paid_amount=Decimal(400),
+            expected_paid_amount_based_on_income=Decimal(600),
+            outgoing_compensation=Decimal(200),
+            ingoing_compensation=Decimal(0),
+            quota_of_total=Decimal("0.4"),
+            recurring_expenses=Decimal(100))
+        snapshot = AccountingSnapshot.from_calculation(calculation)
+
+        self.assertEqual("test_user", snapshot.username)
+        self.assertEqual(Decimal(200), snapshot.outgoing_compensation)
+        rendered = snapshot.as_str(Decimal(1000))
+        self.assertIn("40.00% av totalen 1000.00:-", rendered)
+        self.assertIn("Ska kompensera andra med** 200.00:-", rendered)
+
+
+class TestIncomeSplitSimulator(TestCase):
+
+    def setUp(self) -> None:
+        self.simulator = IncomeSplitSimulator(participants=["a", "b"],
+                                              incomes=[60_000, 40_000],
+                                              paid=[400, 600],
+                                              total_expense_sum=1000)
+
+    def test_compensations(self):
+        # 'a' should carry 60% of the total, but paid 40%
+        compensations = self.simulator.compensations()
+        self.assertEqual((1, 2), compensations.shape)
+        self.assertAlmostEqual(200, compensations[0, 0])
+        self.assertAlmostEqual(-200, compensations[0, 1])
+
+        scenarios = self.simulator.scenarios(0, numpy.linspace(0, 100_000, 1001))
+        compensations = self.simulator.compensations(scenarios)
+        self.assertEqual((1001, 2), compensations.shape)
+        numpy.testing.assert_allclose(0, compensations.sum(axis=1), atol=1e-9)
+
+    def test_break_even_income(self):
+        # 'a' pays exactly their share at 400 / 1000 of the combined income
+        incomes = numpy.linspace(0, 100_000, 1001)
+        self.assertAlmostEqual(26_666.67, self.simulator.break_even_income(0, incomes), 0)
+        self.assertIsNone(self.simulator.break_even_income(0, incomes[:100]))
+        self.assertAlmostEqual(26_666.67, self.simulator.break_even_income(0, incomes[::-1]), 0)
+
+    def test_with_participant(self):
+        simulator = self.simulator.with_participant("c", 100_000)
+        compensations = simulator.compensations()[0]
+        self.assertAlmostEqual(500, compensations[2])
+        self.assertAlmostEqual(0, compensations.sum())
+
+
+class TestParseExpensesInMessage(TestCase):
+
+    def test_parse_several_expenses(self):
+        message = Message("Spara utgifter mat 450, bensin 600 kr, apotek 120:- privat")
+        self.assertEqual(([("mat", 450), ("bensin", 600), ("apotek", 120)], []),
+                         FinanceAbility._parse_expenses_in_message(message))
+
+    def test_parse_single_expense(self):
+        message = Message("spara utgift glass 30")
+        self.assertEqual(([("glass", 30)], []),
+                         FinanceAbility._parse_expenses_in_message(message))
+
+    def test_parse_valid_and_invalid_expenses(self):
+        message = Message("spara utgifter mat 450, bensin sexhundra, apotek 120, 99")
+        self.assertEqual(([("mat", 450), ("apotek", 120)], ["bensin sexhundra", "99"]),
+                         FinanceAbility._parse_expenses_in_message(message))
@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+from jarvis.app import MemoryCache, MemoryCompactor, MemoryIndex
+
+
+class TestMemoryIndex(TestCase):
+
+    def setUp(self):
+        self.index = MemoryIndex(["Jag dricker kaffe med mjölk",
+                                  "Bilen är en Volvo från 2015",
+                                  "Vi åker till Spanien i juli",
+                                  "Kaffet ska vara mörkrost"])
+
+    def test_top_returns_relevant_memories_in_stored_order(self):
+        self.assertEqual(self.index.top("Vilken bil har vi? En volvo?", k=1),
+                         ["Bilen är en Volvo från 2015"])
+        self.assertEqual(self.index.top("Kaffe med mjölk, eller kaffet i juli?", k=2),
+                         ["Jag dricker kaffe med mjölk", "Vi åker till Spanien i juli"])
+
+    def test_top_prefers_recent_memories_without_matches(self):
+        self.assertEqual(self.index.top("Hur mycket kostar det?", k=2),
+                         ["Vi åker till Spanien i juli", "Kaffet ska vara mörkrost"])
+
+    def test_top_returns_all_memories_when_fewer_than_k(self):
+        self.assertEqual(self.index.top("Volvo", k=10), self.index.memories)
+
+    def test_add_updates_index(self):
+        self.index.add("Hunden heter Sixten")
+        self.assertEqual(self.index.top("vad heter hunden", k=1), ["Hunden heter Sixten"])
+
+
+class TestMemoryCache(TestCase):
+
+    def test_evicts_least_recently_used_author(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.put("a", MemoryIndex(["aaaa"]))
+        cache.put("b", MemoryIndex(["bbbb"]))
+        cache.get("a")
+        cache.append("a", "aaa")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a").memories, ["aaaa", "aaa"])
+
+    def test_invalidates_only_the_given_author(self):
+        cache = MemoryCache()
+        cache.put("a", MemoryIndex(["a"]))
+        cache.put("b", MemoryIndex(["b"]))
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        cache.invalidate()
+        self.assertIsNone(cache.get("b"))
+
+
+class TestMemoryCompactor(TestCase):
+
+    def test_duplicates_keeps_the_most_recent_memory(self):
+        memories = ["Jag heter Simon och bor i Göteborg",
+                    "Min bil är en Volvo",
+                    "jag heter Simon, och bor i Göteborg!",
+                    "Min bil är en Saab",
+                    "Jag heter Simon och bor i Göteborg nu"]
+        self.assertEqual(MemoryCompactor(store=None).duplicates(memories), [0, 2])
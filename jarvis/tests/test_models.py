@@ -39,3 +39,41 @@ class TestExpenseModel(TestCase):
         normal_expense.delete()
         recurring_expense.delete()
 
+
+
+class TestUserQuerySet(TestCase):
+    load_dotenv()
+
+    usernames = ("test_alias_owner", "test_alias_sharer_1", "test_alias_sharer_2")
+
+    def setUp(self):
+        self.tearDown()
+        # Two users share an alias equal to the username of a third,
+        # and are stored before it
+        User(username="test_alias_sharer_1", aliases=["test_alias_owner", "Kalle"]).save()
+        User(username="test_alias_sharer_2", aliases=["test_alias_owner"]).save()
+        self.owner = User(username="test_alias_owner", aliases=["Ägaren"])
+        self.owner.save()
+
+    def tearDown(self):
+        User.objects(username__in=self.usernames).delete()
+
+    def test_from_alias(self):
+        self.assertEqual(self.owner.pk, User.objects.from_alias(" ÄGAREN ").pk)
+        self.assertEqual("test_alias_sharer_1", User.objects.from_alias("kalle").username)
+        self.assertIsNone(User.objects.from_alias("Äga"))
+
+    def test_username_supersedes_alias(self):
+        user = User.objects.from_username_or_alias("test_alias_owner")
+        self.assertEqual(self.owner.pk, user.pk)
+        self.assertEqual("test_alias_sharer_1",
+                         User.objects.from_username_or_alias("Kalle").username)
+        self.assertIsNone(User.objects.from_username_or_alias("test_alias_nobody"))
+
+    def test_from_author_returns_fresh_user(self):
+        user = User.objects.from_author("Ägaren")
+        self.assertEqual(self.owner.pk, user.pk)
+
+        # Unsaved changes to one message's user don't reach the next
+        user.username = "changed"
+        self.assertEqual("test_alias_owner", User.objects.from_author("Ägaren").username)
@@ -0,0 +1,81 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from jarvis.utils import ExpiringLRUCache, VocabularyRegistry
+
+
+class TestExpiringLRUCache(TestCase):
+
+    @patch("jarvis.utils.time.monotonic")
+    def test_entries_expire_after_ttl(self, monotonic):
+        cache = ExpiringLRUCache(max_size=2, ttl_seconds=300)
+        monotonic.return_value = 1000
+        cache.put("a", 1)
+
+        monotonic.return_value = 1299
+        self.assertEqual(1, cache.get("a"))
+        monotonic.return_value = 1300
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual("default", cache.get("a", "default"))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ExpiringLRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_invalidate(self):
+        cache = ExpiringLRUCache()
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(2, cache.get("b"))
+        cache.invalidate()
+        self.assertIsNone(cache.get("b"))
+
+
+class TestVocabularyRegistry(TestCase):
+
+    def setUp(self):
+        self.names = ["anna", "bertil"]
+        self.calls = 0
+
+        def provider():
+            self.calls += 1
+            return self.names
+
+        self.registry = VocabularyRegistry()
+        self.registry.register("usernames", provider)
+
+    def test_vocabulary_is_loaded_once(self):
+        valid_strings = self.registry.provider("usernames")
+        self.assertEqual(("anna", "bertil"), valid_strings())
+        self.assertEqual(("anna", "bertil"), valid_strings())
+        self.assertEqual(1, self.calls)
+
+    def test_invalidate_reloads_vocabulary(self):
+        self.registry.get("usernames")
+        self.names.append("cecilia")
+        self.registry.invalidate("usernames")
+        self.assertEqual(("anna", "bertil", "cecilia"), self.registry.get("usernames"))
+        self.assertEqual(2, self.calls)
+
+    @patch("jarvis.utils.time.monotonic")
+    def test_vocabulary_expires_after_ttl(self, monotonic):
+        monotonic.return_value = 1000
+        self.registry.get("usernames")
+        self.names.append("cecilia")
+
+        monotonic.return_value = 1059
+        self.assertEqual(("anna", "bertil"), self.registry.get("usernames"))
+        monotonic.return_value = 1060
+        self.assertEqual(("anna", "bertil", "cecilia"), self.registry.get("usernames"))
+
+    def test_unknown_vocabulary(self):
+        with self.assertRaises(KeyError):
+            self.registry.get("project_names")
@@ -1,3 +1,9 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable
+
 from pyttman.core.containers import Message
 
 
@@ -20,3 +26,99 @@ def get_username_from_message(message: Message) -> str:
     except AttributeError:
         username_for_query = message.author
     return username_for_query
+
+
+class ExpiringLRUCache:
+    """
+    A bounded, thread safe in-process cache. When full, the least
+    recently used entry is evicted. Entries expire 'ttl_seconds'
+    after they were stored, so that changes made by other workers
+    are picked up eventually.
+    """
+
+    def __init__(self, max_size: int = 128, ttl_seconds: int = 300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            if (entry := self._entries.get(key)) is None:
+                return default
+            stored_at, value = entry
+            if time.monotonic() - stored_at >= self.ttl_seconds:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable = None) -> None:
+        """
+        Drop an entry, or all entries if no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class VocabularyRegistry:
+    """
+    Cached vocabularies for entity fields, provided as their
+    'valid_strings'.
+
+    Pyttman evaluates 'valid_strings' while parsing entities, for
+    every candidate intent on every message. The vocabularies are
+    therefore kept in memory, loaded from their provider and
+    reloaded when the write paths which change them call
+    'invalidate' - so entity parsing doesn't query the database.
+    Since other workers and scripts may change them as well, a
+    vocabulary is reloaded when it's older than 'ttl_seconds'.
+    """
+
+    def __init__(self, ttl_seconds: int = 60):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._providers: dict[str, Callable[[], Iterable[str]]] = {}
+        self._vocabularies: dict[str, tuple[float, tuple[str]]] = {}
+
+    def register(self, name: str, provider: Callable[[], Iterable[str]]) -> None:
+        self._providers[name] = provider
+
+    def provider(self, name: str) -> Callable[[], tuple[str]]:
+        """
+        A callable for 'valid_strings', returning the cached vocabulary.
+        """
+        return functools.partial(self.get, name)
+
+    def get(self, name: str) -> tuple[str]:
+        with self._lock:
+            entry = self._vocabularies.get(name)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl_seconds:
+            return self.reload(name)
+        return entry[1]
+
+    def reload(self, name: str) -> tuple[str]:
+        vocabulary = tuple(self._providers[name]())
+        with self._lock:
+            self._vocabularies[name] = (time.monotonic(), vocabulary)
+        return vocabulary
+
+    def invalidate(self, name: str) -> None:
+        """
+        Reload a vocabulary after it has changed. It's reloaded
+        eagerly, so that the next message is parsed from memory.
+        """
+        self.reload(name)
+
+
+vocabularies = VocabularyRegistry()